@@ -1,14 +1,121 @@
 import torch
 import clip
+import json
 import pprint
+from contextlib import contextmanager
+from pathlib import Path
+from TorchScriptEncoder import TorchScriptEncoder
+from OnnxEncoder import OnnxEncoder
+
+
+# Text encoder of the CLIP model as a module (for exporting it)
+class TextEncoderModule(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens):
+        return self.model.encode_text(tokens)
 
 
 class CLIPWrapper:
-    def __init__(self, model_name="ViT-B/32", prefer_cuda=False) -> None:
-        self.device = "cuda" if prefer_cuda and torch.cuda.is_available() else "cpu"
+    backends = {"torchscript": TorchScriptEncoder, "onnx": OnnxEncoder}
+    # Minimal cosine similarity of the embeddings computed by an exported backend and by the eager model
+    consistency_threshold = 0.999
+    # Precision modes of the inference on CPU: full, dynamically quantized linear layers, bfloat16 autocast
+    precisions = ("fp32", "int8", "bf16")
+
+    def __init__(self, model_name="ViT-B/32", prefer_cuda=False, backend="torch", threads=0,
+                 export_dir="instance/exported", precision="fp32") -> None:
+        self.device = CLIPWrapper.select_device(prefer_cuda)
         self.log(f"Using device: {self.device}")
+        self.model_name = model_name
         self.model, self.preprocess = clip.load(model_name, device=self.device)
+        # The full precision model, used by the zero-shot classification in all the precision modes
+        self.fp32_model = self.model
+        self.input_resolution = self.model.visual.input_resolution
+        # Object computing the embeddings (with the encode_image() and encode_text() methods)
+        self.encoder = self.model
         self.log(f"Model {model_name} loaded.")
+        self.precision = "fp32"
+        if precision != "fp32" and backend == "torch":
+            self.set_precision(precision)
+        elif precision != "fp32":
+            self.log(f"Warning: the {precision} precision is supported only by the torch backend, using fp32.")
+        if backend != "torch":
+            self.load_backend(backend, threads, export_dir)
+
+    """
+    Name identifying the embeddings computed by the model: the name of the
+    model, tagged by the precision mode if it is not fp32. The embeddings of
+    different precision modes are not mixed in the indexes and caches.
+    """
+    @property
+    def embedding_name(self):
+        return CLIPWrapper.tagged_name(self.model_name, self.precision)
+
+    # Returns the embedding name of the model in the precision mode (before the model is loaded).
+    @staticmethod
+    def tagged_name(model_name, precision):
+        if precision == "fp32":
+            return model_name
+        return f"{model_name}-{precision}"
+
+    # Returns the device the model is loaded to.
+    @staticmethod
+    def select_device(prefer_cuda=False):
+        return "cuda" if prefer_cuda and torch.cuda.is_available() else "cpu"
+
+    """
+    Returns the precision mode the model uses with the backend on the device
+    (the modes that are not supported fall back to fp32, see set_precision()),
+    so the embedding name is known before the model is loaded.
+    """
+    @staticmethod
+    def resolve_precision(precision, backend="torch", device="cpu"):
+        if precision not in CLIPWrapper.precisions or backend != "torch" or device != "cpu":
+            return "fp32"
+        if precision == "bf16" and not CLIPWrapper.bf16_supported():
+            return "fp32"
+        return precision
+
+    # Returns True if the CPU supports the bfloat16 operations natively.
+    @staticmethod
+    def bf16_supported():
+        try:
+            return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+        except (AttributeError, RuntimeError):
+            return False
+
+    """
+    Sets the precision mode of the inference on CPU: "int8" quantizes the
+    weights of the linear layers dynamically (the activations are quantized
+    on the fly), "bf16" runs the encoders under the bfloat16 autocast (only on
+    the CPUs supporting bfloat16). If the mode cannot be used, fp32 is kept.
+    """
+    def set_precision(self, precision):
+        if precision not in self.precisions:
+            self.log(f"Warning: unknown precision '{precision}', using fp32.")
+        elif self.device != "cpu":
+            self.log(f"The {precision} precision is used only on CPU, using fp32.")
+        elif precision == "bf16" and not self.bf16_supported():
+            self.log("Warning: the CPU does not support bfloat16, using fp32.")
+        else:
+            if precision == "int8":
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+                self.encoder = self.model
+            self.precision = precision
+            self.log(f"Using the {precision} precision.")
+
+    # Context of the inference: no gradients, and the bfloat16 autocast in the bf16 precision mode.
+    @contextmanager
+    def inference(self):
+        with torch.no_grad():
+            if self.precision == "bf16":
+                with torch.autocast("cpu", dtype=torch.bfloat16):
+                    yield
+            else:
+                yield
 
     def Create(*, prefer_cuda=False, **kwargs):
         # If prefer_cuda == True, try to load model on GPU
@@ -29,26 +136,113 @@ class CLIPWrapper:
     def log(self, *args):
         print("CLIPWrapper:", *args)
 
-    def img2vec(self, img):
+    """
+    Replaces the eager encoders by the ones exported for the backend
+    ("torchscript" or "onnx", see TorchScriptEncoder and OnnxEncoder). The
+    encoders are exported to a subdirectory of export_dir once, and they are
+    used only if they pass the consistency check against the eager model.
+    Otherwise (and on GPU), the eager model is kept.
+    """
+    def load_backend(self, backend, threads=0, export_dir="instance/exported"):
+        encoder_class = self.backends.get(backend)
+        if encoder_class is None:
+            self.log(f"Warning: unknown backend '{backend}', using the eager model.")
+            return
+        if self.device != "cpu":
+            self.log(f"The {backend} backend is used only on CPU, using the eager model.")
+            return
+        if encoder_class is OnnxEncoder and not OnnxEncoder.available():
+            self.log("Warning: onnxruntime is not installed, using the eager model.")
+            return
+
+        directory = Path(export_dir) / f"{self.model_name.replace('/', '-')}-{backend}"
+        try:
+            if not self.is_exported(encoder_class, directory):
+                self.log(f"Exporting the encoders to {directory}...")
+                self.export(encoder_class, directory)
+            encoder = encoder_class.load(directory, threads)
+            similarity = self.check_consistency(encoder)
+        except Exception as e:
+            self.log(f"Warning: the {backend} backend failed ({e}), using the eager model.")
+            return
+        if similarity < self.consistency_threshold:
+            self.log(f"Warning: the {backend} backend is not consistent with the eager model "
+                     f"(cosine similarity {similarity:.5f}), using the eager model.")
+            return
+        self.encoder = encoder
+        self.log(f"Using the {backend} backend (cosine similarity to the eager model {similarity:.5f}).")
+
+    # Returns the description of the export, which must match the one saved with the exported encoders.
+    def export_info(self, encoder_class):
+        return {"model": self.model_name, "backend": encoder_class.name, "torch": torch.__version__}
+
+    def is_exported(self, encoder_class, directory):
+        try:
+            with open(directory / "export.json", "r") as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        files_exist = all((directory / filename).is_file() for filename in encoder_class.filenames.values())
+        return files_exist and info == self.export_info(encoder_class)
+
+    # Exports the image and text encoders of the eager model by the encoder class to the directory.
+    def export(self, encoder_class, directory):
+        directory.mkdir(parents=True, exist_ok=True)
+        resolution = self.input_resolution
+        modules = {"image": self.model.visual, "text": TextEncoderModule(self.model)}
+        examples = {
+            "image": torch.randn(2, 3, resolution, resolution, dtype=self.model.dtype),
+            "text": clip.tokenize(["a photo of a dog", "a diagram"]),
+        }
+        encoder_class.export(modules, examples, directory)
+        with open(directory / "export.json", "w") as f:
+            json.dump(self.export_info(encoder_class), f, indent="\t")
+
+    # Returns the minimal cosine similarity of the embeddings computed by the encoder and by the eager model.
+    def check_consistency(self, encoder):
+        generator = torch.Generator().manual_seed(0)
+        resolution = self.input_resolution
+        images = torch.randn(3, 3, resolution, resolution, generator=generator, dtype=self.model.dtype)
+        tokens = clip.tokenize(["a photo of a cat", "a red car parked on the street", "a diagram"])
         with torch.no_grad():
+            pairs = [
+                (self.model.encode_image(images), encoder.encode_image(images)),
+                (self.model.encode_text(tokens), encoder.encode_text(tokens)),
+            ]
+        return min(
+            torch.nn.functional.cosine_similarity(expected.float(), actual.float()).min().item()
+            for expected, actual in pairs
+        )
+
+    def img2vec(self, img):
+        with self.inference():
             img = self.preprocess(img).unsqueeze(0).to(self.device)
-            return self.model.encode_image(img)
+            return self.encoder.encode_image(img)
             # return image_features / image_features.norm(dim=-1, keepdim=True)
 
     def imgs2vec(self, imgs):
-        with torch.no_grad():
-            data = []
-            for img in imgs:
-                data.append(self.preprocess(img).unsqueeze(0).to(self.device))
+        return self.encode_images(torch.stack([self.preprocess_image(img) for img in imgs]))
+
+    # Returns the preprocessed image as a tensor ready for encode_images().
+    def preprocess_image(self, img):
+        return self.preprocess(img)
 
-            return self.model.encode_image(torch.cat(data))
+    # Embeds a batch of images preprocessed by preprocess_image().
+    def encode_images(self, tensors):
+        with self.inference():
+            return self.encoder.encode_image(tensors.to(self.device))
             # return image_features / image_features.norm(dim=-1, keepdim=True)
 
 
+    # Embeds a list of texts.
+    def encode_texts(self, texts):
+        with self.inference():
+            return self.encoder.encode_text(clip.tokenize(texts).to(self.device))
+
     def text2vec(self, text):
-        with torch.no_grad():
+        with self.inference():
             text = clip.tokenize(text).to(self.device)
-            return self.model.encode_text(text)
+            return self.encoder.encode_text(text)
         # text_features = self.model.encode_text(text)
         # return text_features / text_features.norm(dim=-1, keepdim=True)
 
@@ -57,13 +251,13 @@ class CLIPWrapper:
         text = clip.tokenize(labels).to(self.device)
 
         with torch.no_grad():
-            image_features = self.model.encode_image(image)
-            text_features = self.model.encode_text(text)
+            image_features = self.fp32_model.encode_image(image)
+            text_features = self.fp32_model.encode_text(text)
 
             image_features /= image_features.norm(dim=-1, keepdim=True)
             text_features /= text_features.norm(dim=-1, keepdim=True)
 
-            logits_per_image, logits_per_text = self.model(image, text)
+            logits_per_image, logits_per_text = self.fp32_model(image, text)
             probs = logits_per_image.softmax(dim=-1).cpu().numpy()
 
         result = dict(
@@ -0,0 +1,158 @@
+import os
+import threading
+from time import monotonic, sleep
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+# Passes the file system events reported by watchdog to the DirectoryWatcher.
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        # Changes of the directories themselves (e.g. their modified times) are not interesting
+        if event.is_directory and event.event_type in ("modified", "opened", "closed", "closed_no_write"):
+            return
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        self.watcher.notify(event.src_path, event.is_directory)
+        if getattr(event, "dest_path", ""):
+            self.watcher.notify(event.dest_path, event.is_directory)
+
+
+"""
+Watches the image library for new, modified and deleted images, and passes
+their paths in batches to the callback (e.g. a refresh of only these paths,
+see ImageManager.get_refresh_generators()).
+
+The events are reported by the `watchdog` package (inotify on Linux) if it is
+installed. Otherwise, the library is scanned by the FileScanner every
+`poll_interval` seconds and compared with the previous scan, which costs only
+listing the directories (no image is read).
+
+The events are debounced: the batch is passed to the callback once no event
+came for `debounce` seconds (so the files being copied are complete), but at
+the latest `max_delay` seconds after its first event (so a continuous stream
+of uploads is ingested as it comes). The callback runs in the dispatcher
+thread, the events arriving meanwhile form the next batch. If the callback
+fails, the batch is retried with the next one (at most `max_retries` times).
+"""
+class DirectoryWatcher:
+    def __init__(self, root, callback, scanner, debounce=2.0, max_delay=30.0, poll_interval=10.0,
+                 use_events=True, max_retries=3):
+        self.root = os.path.normpath(root)
+        self.callback = callback
+        self.scanner = scanner
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.use_events = use_events and Observer is not None
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.retries = {}
+        self.first_event = None
+        self.last_event = None
+        self.stopped = False
+        self.observer = None
+        self.threads = []
+
+    # Adds the path of a changed file (or directory) to the next batch, unless it is not an image.
+    def notify(self, path, is_directory=False):
+        path = os.path.normpath(path)
+        name = os.path.basename(path)
+        if name.startswith(".") or (not is_directory and not self.scanner.accepts(name) and not os.path.isdir(path)):
+            return
+        self.add([path])
+
+    def add(self, paths):
+        with self.condition:
+            now = monotonic()
+            if not self.pending:
+                self.first_event = now
+            self.pending.update(paths)
+            self.last_event = now
+            self.condition.notify()
+
+    def start(self):
+        if self.use_events:
+            self.observer = Observer()
+            self.observer.schedule(_EventHandler(self), self.root, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+            print(f"Watching {self.root} for changes")
+        else:
+            self.threads.append(threading.Thread(target=self.poll, name="DirectoryWatcher.poll", daemon=True))
+            print(f"Polling {self.root} for changes every {self.poll_interval} s")
+        self.threads.append(threading.Thread(target=self.dispatch, name="DirectoryWatcher", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.observer is not None:
+            self.observer.stop()
+
+    # Scans the library periodically and notifies the paths that differ from the previous scan.
+    def poll(self):
+        previous = self.scanner.scan(self.root)
+        while not self.stopped:
+            sleep(self.poll_interval)
+            try:
+                files = self.scanner.scan(self.root)
+            except OSError as e:
+                print(f"DirectoryWatcher: {e}")
+                continue
+            for path in files.keys() ^ previous.keys():
+                self.notify(path)
+            for path, file in files.items():
+                old = previous.get(path)
+                if old is not None and (old.mtime, old.size) != (file.mtime, file.size):
+                    self.notify(path)
+            previous = files
+
+    # Waits for the next debounced batch of paths, returns None if the watcher was stopped.
+    def next_batch(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                now = monotonic()
+                ready_at = min(self.last_event + self.debounce, self.first_event + self.max_delay)
+                if now >= ready_at:
+                    batch = sorted(self.pending)
+                    self.pending = set()
+                    return batch
+                self.condition.wait(ready_at - now)
+            return None
+
+    def dispatch(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                self.callback(batch)
+                for path in batch:
+                    self.retries.pop(path, None)
+            except Exception as e:
+                print(f"DirectoryWatcher: ingesting {len(batch)} paths failed: {e!r}")
+                retry = []
+                for path in batch:
+                    self.retries[path] = self.retries.get(path, 0) + 1
+                    if self.retries[path] <= self.max_retries:
+                        retry.append(path)
+                    else:
+                        del self.retries[path]
+                if retry:
+                    self.add(retry)
@@ -0,0 +1,54 @@
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from pathlib import Path
+
+"""
+Persistent cache of image embeddings keyed by pairs (content hash, model name).
+
+The embeddings are stored in a separate SQLite database, independent of the
+image database of each model, so they survive resetting the library and
+moving or renaming the image files. Re-ingesting an already known image then
+costs only reading and hashing the file, not running the CLIP model.
+"""
+class EmbeddingCache:
+    def __init__(self, path, model_name):
+        self.model_name = model_name
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embedding ("
+                "hash BLOB NOT NULL, model TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (hash, model)) WITHOUT ROWID"
+            )
+
+    # Returns the hash of the file content.
+    @staticmethod
+    def hash(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    # Returns the cached embedding (float32 vector) for the hash, or None.
+    def get(self, hash):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT vector FROM embedding WHERE hash = ? AND model = ?",
+                (hash, self.model_name),
+            ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    # Stores the embeddings (rows of the matrix) for the given hashes.
+    def put(self, hashes, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        rows = [
+            (hash, self.model_name, embedding.tobytes())
+            for hash, embedding in zip(hashes, embeddings)
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embedding (hash, model, vector) VALUES (?, ?, ?)", rows
+            )
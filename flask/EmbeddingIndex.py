@@ -0,0 +1,691 @@
+import numpy as np
+import copy
+import json
+import os
+import secrets
+import zlib
+from pathlib import Path
+from PathTable import PathTable
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+"""
+Exact cosine similarity index over the image embeddings.
+
+The embeddings are L2-normalized and kept in one contiguous float32 matrix,
+so the cosine similarity of a query and all the images is a single matrix
+product. The matrix is processed in blocks of `block_size` rows to keep the
+temporary score matrix small, and only the k best candidates of each block
+are kept (selected by `np.argpartition`, i.e. without sorting the block).
+
+Each row of the matrix (a "slot") belongs to the image with the database id
+stored at the same position of the `ids` array. Images can be added (appended
+to new slots), updated (moved to new slots) and removed. Removed slots are
+only marked by the id -1 (a tombstone) and skipped by the search, until the
+index is compacted, i.e. rewritten without them. Optionally, the index
+also stores the path and modified time of the image in each slot (see the
+PathTable class), so the results can be shown without querying the database.
+
+To reduce the memory used by the search, the index can also keep compact
+codes of the embeddings (`storage` "float16", or "int8" quantized with a
+separate scale and offset of each dimension). The first pass of the search
+then scores only the codes, and the `rerank * k` best candidates are scored
+again exactly with the float32 embeddings, which are read only for them.
+
+On the disk, the index is a directory with a raw float32 matrix, a raw int64
+array of ids and a small JSON header (format version, model name, dimension,
+count, and CRC32 checksum of each block of rows). The files are opened with
+`numpy.memmap`, so loading the index costs nothing regardless of the library
+size - the pages are read lazily by the first queries and are shared through
+the OS page cache by all the processes that open the same index.
+
+The files mapped by an instance of the index are never changed by another
+instance (or process) opening the same directory: the embeddings, codes and
+paths of the new slots are only appended behind the mapped rows, and the ids
+with the new tombstones are kept in memory until flush() writes them to a new
+file and replaces the header. So an instance can be changed (e.g. by a
+refresh) while the searches keep using the previous one.
+"""
+class EmbeddingIndex:
+    block_size = 65536
+    checksum_block_size = 4096
+    compact_threshold = 0.25
+    format_name = "clip-search-embeddings"
+    format_version = 2
+    header_filename = "header.json"
+    storage_types = {"float32": None, "float16": np.float16, "int8": np.int8}
+    # Number of rows of the codes converted to float32 at once by the search
+    code_block_size = 8192
+    # Files of the structures the subclasses save next to the index (see _save_structures())
+    structure_filenames = ()
+    read_only = False
+
+    def __init__(
+        self, data, ids=None, model_name=None, paths=None, mtimes=None, storage="float32", rerank=4
+    ):
+        self.data = self.normalize(data)
+        if ids is None:
+            ids = np.arange(1, self.data.shape[0] + 1)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.paths = None if paths is None else PathTable(paths, mtimes)
+        self.model_name = model_name
+        self.directory = None
+        self.header = None
+        self.deleted = 0
+        self._slots = None
+        self.configure_storage(storage, rerank)
+        self.target_storage = storage
+
+    # Sets the type of the codes (written by the next save) and the re-ranking factor.
+    def configure_storage(self, storage="float32", rerank=4):
+        if storage not in self.storage_types:
+            raise ValueError(f"Unknown embedding storage: {storage}")
+        self.storage = storage
+        self.rerank = rerank
+        self.codes = None
+
+    # Returns the number of images in the index (without the removed ones).
+    def __len__(self):
+        return self.data.shape[0] - self.deleted
+
+    # Returns the embeddings as a contiguous float32 matrix with L2-normalized rows.
+    @staticmethod
+    def normalize(data):
+        data = np.array(data, dtype=np.float32, copy=True, order="C", ndmin=2)
+        norms = np.linalg.norm(data, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        data /= norms
+        return data
+
+    # Returns the dictionary mapping the image ids to their slots.
+    @property
+    def slots(self):
+        if self._slots is None:
+            live = np.flatnonzero(self.ids >= 0)
+            self._slots = dict(zip(self.ids[live].tolist(), live.tolist()))
+        return self._slots
+
+    # Returns True if the index contains the image with the given id.
+    def __contains__(self, id):
+        return id in self.slots
+
+    # Returns the normalized embedding of the image with the given id.
+    def vector(self, id):
+        return self.data[self.slots[id]]
+
+    # Returns a view of the slots [start, stop) of the index, which shares the (memory-mapped)
+    # data with the index and can be searched on its own. The view must not be modified.
+    def shard(self, start, stop):
+        shard = copy.copy(self)
+        shard.data = self.data[start:stop]
+        shard.ids = self.ids[start:stop]
+        if self.codes is not None:
+            shard.codes = self.codes[start:stop]
+        shard.deleted = int(np.count_nonzero(np.asarray(shard.ids) < 0))
+        shard._slots = None
+        return shard
+
+    # Returns the pair (path, mtime) of the image with the given id from the path table.
+    def path(self, id):
+        slot = self.slots[id]
+        return self.paths.path(slot), self.paths.mtime(slot)
+
+    """
+    Returns the k most similar images for each of the query vectors. The queries
+    can be a single vector or a matrix with one query per row. Returns a tuple
+    (scores, ids) of arrays with shape (n_queries, k), sorted by decreasing
+    cosine similarity. If the index contains less than k images, only len(self)
+    results are returned.
+    """
+    def search(self, queries, k=1):
+        queries = self.normalize(queries)
+        k = min(k, len(self))
+        if k <= 0:
+            empty = np.empty((queries.shape[0], 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+
+        if self.codes is None:
+            scores, slots = self._search_blocks(self.data, k, self.block_size, lambda block: queries @ block.T)
+            return scores, np.asarray(self.ids)[slots]
+
+        # First pass on the codes, then exact scores of the best candidates
+        candidates = k if self.rerank <= 0 else min(len(self), self.rerank * k)
+        scores, slots = self._search_blocks(self.codes, candidates, self.code_block_size, self.code_scorer(queries))
+        if self.rerank > 0:
+            for i, query in enumerate(queries):
+                order = np.argsort(slots[i])
+                scores[i, order] = self.data[slots[i, order]] @ query
+            top = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+            scores = np.take_along_axis(scores, top, axis=1)
+            slots = np.take_along_axis(slots, top, axis=1)
+        return scores, np.asarray(self.ids)[slots]
+
+    """
+    Returns the function computing the approximate scores of the queries and a
+    block of the codes. For the int8 codes, x = (c + 128) * scale + offset,
+    so q.x = (q * scale).c + q.(128 * scale + offset).
+    """
+    def code_scorer(self, queries):
+        if self.codes.dtype == np.int8:
+            scaled = queries * self.code_scale
+            bias = queries @ (128 * self.code_scale + self.code_offset)
+            return lambda block: scaled @ block.astype(np.float32).T + bias[:, None]
+        return lambda block: queries @ block.astype(np.float32).T
+
+    """
+    Returns the k best scores of the queries and the rows of the matrix
+    (scores, slots) sorted by decreasing score. The matrix is processed in
+    blocks of the given size, `score` returns the scores for a block.
+    """
+    def _search_blocks(self, matrix, k, block_size, score):
+        n = matrix.shape[0]
+        best_scores = []
+        best_indices = []
+        for start in range(0, n, block_size):
+            scores = score(matrix[start : start + block_size])
+            scores[:, self.ids[start : start + block_size] < 0] = -np.inf
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores.append(scores)
+            best_indices.append(top + start)
+
+        scores = np.concatenate(best_scores, axis=1)
+        indices = np.concatenate(best_indices, axis=1)
+        # Merge the candidates of all the blocks and sort the final k results
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, top, axis=1)
+            indices = np.take_along_axis(indices, top, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    # Returns the CRC32 checksum of the rows [start, stop) of the given matrix and ids.
+    @staticmethod
+    def checksum(data, ids, start, stop):
+        crc = zlib.crc32(np.ascontiguousarray(data[start:stop]))
+        return zlib.crc32(np.ascontiguousarray(ids[start:stop]), crc)
+
+    # Returns the checksums of all the blocks of rows of the given matrix and ids.
+    @staticmethod
+    def checksums(data, ids, block_size):
+        return [
+            EmbeddingIndex.checksum(data, ids, start, start + block_size)
+            for start in range(0, data.shape[0], block_size)
+        ]
+
+    def _vectors_path(self):
+        return self.directory / self.header["vectors"]
+
+    def _ids_path(self):
+        return self.directory / self.header["ids"]
+
+    # Memory-maps the files described by the header (read-only). If the ids are given
+    # (changed in memory and not flushed yet), they are used instead of the ids file.
+    def _map(self, ids=None):
+        count, dim = self.header["count"], self.header["dim"]
+        self._ids_changed = ids is not None
+        if count > 0:
+            self.data = np.memmap(self._vectors_path(), dtype=np.float32, mode="r", shape=(count, dim))
+            if ids is None:
+                ids = np.memmap(self._ids_path(), dtype=np.int64, mode="r", shape=(count,))
+        else:
+            self.data = np.empty((0, dim), dtype=np.float32)
+            ids = np.empty((0,), dtype=np.int64)
+        self.ids = ids
+        self.deleted = self.header["deleted"]
+        self.codes = None
+        codes = self.header.get("codes")
+        if codes is not None:
+            self.storage = codes["dtype"]
+            dtype = self.storage_types[self.storage]
+            if count > 0:
+                self.codes = np.memmap(self.directory / codes["file"], dtype=dtype, mode="r", shape=(count, dim))
+            else:
+                self.codes = np.empty((0, dim), dtype=dtype)
+            self.code_scale = np.array(codes["scale"], dtype=np.float32)
+            self.code_offset = np.array(codes["offset"], dtype=np.float32)
+        else:
+            self.storage = "float32"
+        self.paths = None
+        if self.header.get("paths") is not None:
+            self.paths = PathTable.load(self.directory, self.header["paths"], count)
+        self._slots = None
+        self._dirty = set()
+
+    # Returns the codes of the given rows of embeddings.
+    def encode(self, data):
+        dtype = self.storage_types[self.storage]
+        if dtype == np.int8:
+            codes = np.rint((data - self.code_offset) / self.code_scale) - 128
+            return np.clip(codes, -128, 127).astype(np.int8)
+        return np.asarray(data).astype(dtype)
+
+    """
+    Computes the quantization parameters of the int8 codes (the range of each
+    dimension of the embeddings in the given slots is mapped to 256 levels).
+    The float16 codes use the identity.
+    """
+    def _code_parameters(self, slots):
+        dim = self.data.shape[1]
+        self.code_scale = np.ones(dim, dtype=np.float32)
+        self.code_offset = np.zeros(dim, dtype=np.float32)
+        live = slots[np.asarray(self.ids)[slots] >= 0]
+        if self.storage != "int8" or len(live) == 0:
+            return
+        low = np.full(dim, np.inf, dtype=np.float32)
+        high = np.full(dim, -np.inf, dtype=np.float32)
+        for start in range(0, len(live), self.block_size):
+            block = self.data[live[start : start + self.block_size]]
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        self.code_scale = np.maximum((high - low) / 255, 1e-8).astype(np.float32)
+        self.code_offset = low
+
+    # Writes the codes of the embeddings in the given slots to a new file, returns the header entry of the codes.
+    def _write_codes(self, directory, token, slots):
+        self._code_parameters(slots)
+        extension = "f16" if self.storage == "float16" else "i8"
+        filename = f"codes-{token}.{extension}"
+        with open(directory / filename, "wb") as f:
+            for start in range(0, len(slots), self.checksum_block_size):
+                self.encode(self.data[slots[start : start + self.checksum_block_size]]).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        return {
+            "dtype": self.storage,
+            "file": filename,
+            "scale": self.code_scale.tolist(),
+            "offset": self.code_offset.tolist(),
+        }
+
+    # Writes the header to the disk. Replacing the file is atomic, so the
+    # readers always see a consistent header.
+    def _write_header(self):
+        tmp = self.directory / (self.header_filename + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.header, f, indent="\t")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.directory / self.header_filename)
+
+    """
+    Writes the given slots (all if None) of the index to new files in the
+    given directory, replaces the header pointing to them, and removes the
+    files of the previous versions (the processes that still have them mapped
+    keep their pages until they unmap them). The files (including the data
+    structures of the subclasses) are written first and the header last, so the processes that are loading the index at the
+    same time see either the old or the new version, never a mix of both.
+    """
+    def _rewrite(self, directory, slots=None):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        kept = slots
+        if slots is None:
+            slots = np.arange(self.data.shape[0])
+
+        token = secrets.token_hex(8)
+        vectors_filename = f"vectors-{token}.f32"
+        ids_filename = f"ids-{token}.i64"
+        checksums = []
+        with open(directory / vectors_filename, "wb") as fv, open(directory / ids_filename, "wb") as fi:
+            for start in range(0, len(slots), self.checksum_block_size):
+                chunk = slots[start : start + self.checksum_block_size]
+                data = np.ascontiguousarray(self.data[chunk])
+                ids = np.ascontiguousarray(self.ids[chunk])
+                data.tofile(fv)
+                ids.tofile(fi)
+                checksums.append(self.checksum(data, ids, 0, len(chunk)))
+            for f in (fv, fi):
+                f.flush()
+                os.fsync(f.fileno())
+        paths_files = None
+        if self.paths is not None:
+            paths_files = self.paths.save(directory, token, slots)
+        codes = None
+        if self.storage != "float32":
+            codes = self._write_codes(directory, token, slots)
+
+        self.directory = directory
+        self.header = self._new_header(
+            self.model_name, self.data.shape[1], len(slots), int(np.count_nonzero(self.ids[slots] < 0)),
+            vectors_filename, ids_filename, paths_files, codes, checksums,
+        )
+        self._map()
+        self._save_structures(kept)
+        self._write_header()
+        self._remove_old_files()
+
+    """
+    Called before a new version of the index is published by writing its
+    header (by _rewrite(), flush() and create()), the subclasses save their
+    own data structures of the new version here. `slots` are the old slots
+    kept by _rewrite() in their new order, None if the slots did not move.
+    """
+    def _save_structures(self, slots=None):
+        pass
+
+    """
+    Builds and saves the structures of the subclasses that do not match the
+    files (see needs_build()), e.g. in the background after the index was
+    loaded. Yields after each of the build_steps() steps.
+    """
+    def build_structures(self):
+        yield
+        self._save_structures()
+
+    def build_steps(self):
+        return 1
+
+    # Returns the header of the index with the given files.
+    @classmethod
+    def _new_header(cls, model_name, dim, count, deleted, vectors, ids, paths, codes, checksums):
+        return {
+            "format": cls.format_name,
+            "version": cls.format_version,
+            "model": model_name,
+            "dim": dim,
+            "count": count,
+            "deleted": deleted,
+            "dtype": "float32",
+            "vectors": vectors,
+            "ids": ids,
+            "paths": paths,
+            "codes": codes,
+            "block_size": cls.checksum_block_size,
+            "checksums": checksums,
+        }
+
+    # Removes the files of the previous versions of the index (the ones the header does not refer to).
+    def _remove_old_files(self):
+        header = self.header
+        current = {header["vectors"], header["ids"]} | set((header["paths"] or {}).values())
+        if header["codes"] is not None:
+            current.add(header["codes"]["file"])
+        patterns = ("vectors-*.f32", "ids-*.i64", "paths-*.bin", "offsets-*.i64", "mtimes-*.f64", "codes-*")
+        for pattern in patterns:
+            for file in self.directory.glob(pattern):
+                if file.name not in current:
+                    file.unlink()
+
+    # Dumps the index to the given directory and memory-maps it from there.
+    def save(self, directory):
+        self._rewrite(directory)
+
+    """
+    Creates the index in the given directory from the chunks (ids, data,
+    paths, mtimes) of the images, without holding all of them in the memory:
+    the embeddings of each chunk are normalized and appended to new files,
+    and the subclasses build their own structures from them (the keyword
+    arguments are passed to _after_load()). The header is written last. If
+    `store_paths` is False, the paths and mtimes of the chunks are ignored.
+    The files of the previous index in the directory are replaced the same
+    as by save().
+    """
+    @classmethod
+    def create(cls, directory, chunks, dim, model_name=None, store_paths=True, **kwargs):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        token = secrets.token_hex(8)
+        vectors_filename = f"vectors-{token}.f32"
+        ids_filename = f"ids-{token}.i64"
+        paths, paths_files = None, None
+        if store_paths:
+            paths = PathTable()
+            paths_files = paths.save(directory, token)
+
+        count, deleted = 0, 0
+        with open(directory / vectors_filename, "wb") as fv, open(directory / ids_filename, "wb") as fi:
+            for ids, data, chunk_paths, mtimes in chunks:
+                ids = np.array(ids, dtype=np.int64).reshape(-1)
+                if len(ids) == 0:
+                    continue
+                cls.normalize(data).tofile(fv)
+                ids.tofile(fi)
+                if paths is not None:
+                    paths.append(chunk_paths, mtimes)
+                    PathTable.load(directory, paths_files, count + len(ids), into=paths)
+                count += len(ids)
+                deleted += int(np.count_nonzero(ids < 0))
+            for f in (fv, fi):
+                f.flush()
+                os.fsync(f.fileno())
+
+        # The checksums are computed from the files, block by block
+        if count > 0:
+            data = np.memmap(directory / vectors_filename, dtype=np.float32, mode="r", shape=(count, dim))
+            ids = np.memmap(directory / ids_filename, dtype=np.int64, mode="r", shape=(count,))
+            checksums = cls.checksums(data, ids, cls.checksum_block_size)
+            del data, ids
+        else:
+            checksums = []
+
+        index = cls.__new__(cls)
+        index.model_name = model_name
+        index.directory = directory
+        index.header = cls._new_header(
+            model_name, dim, count, deleted, vectors_filename, ids_filename, paths_files, None, checksums
+        )
+        index.configure_storage()
+        index._map()
+        storage = kwargs.get("storage")
+        if storage is not None and storage != "float32":
+            index.configure_storage(storage)
+            index.header["codes"] = index._write_codes(directory, token, np.arange(count))
+            index._map()
+        # The structures of the subclasses are built from the mapped files,
+        # the header that refers to all of them is written last
+        index._after_load(**kwargs)
+        index._save_structures()
+        index._write_header()
+        index._remove_old_files()
+        return index
+
+    """
+    Opens the index saved by save() in the given directory. The files are
+    memory-mapped read-only, only the header is actually read. Raises
+    FileNotFoundError if there is no index in the directory and
+    IndexFormatError if the header does not describe a valid index for the
+    given model. The keyword arguments are passed to the subclasses. If
+    `read_only` is True, nothing is written to the directory (the codes are
+    not converted), e.g. when the index is loaded by a process that only
+    searches it. The structures of the subclasses that do not match the
+    files are never built here, see build_structures().
+    """
+    @classmethod
+    def load(cls, directory, model_name=None, read_only=False, **kwargs):
+        directory = Path(directory)
+        with open(directory / cls.header_filename, "r") as f:
+            header = json.load(f)
+
+        if header.get("format") != cls.format_name:
+            raise IndexFormatError(f"{directory} does not contain an embedding index")
+        if header.get("version") != cls.format_version:
+            raise IndexFormatError(f"Unsupported index version: {header.get('version')}")
+        if model_name is not None and header["model"] != model_name:
+            raise IndexFormatError(
+                f"Index was created for model {header['model']}, not {model_name}"
+            )
+
+        # The files may be longer than the header says, if the application
+        # was interrupted while appending to them
+        count, dim = header["count"], header["dim"]
+        sizes = {header["vectors"]: count * 4 * dim, header["ids"]: count * 8}
+        if header.get("paths") is not None:
+            sizes.update(PathTable.file_sizes(header["paths"], count))
+        if header.get("codes") is not None:
+            itemsize = np.dtype(cls.storage_types[header["codes"]["dtype"]]).itemsize
+            sizes[header["codes"]["file"]] = count * itemsize * dim
+        for filename, size in sizes.items():
+            if (directory / filename).stat().st_size < size:
+                raise IndexFormatError(f"Size of {directory / filename} does not match the header")
+
+        index = cls.__new__(cls)
+        index.model_name = header["model"]
+        index.directory = directory
+        index.header = header
+        index.read_only = read_only
+        index.configure_storage()
+        index._map()
+        index._after_load(**kwargs)
+        return index
+
+    """
+    Called when the index is loaded, subclasses load their own data structures
+    here. If the index was saved with another type of codes than the given
+    storage, the codes are converted (unless the index is read-only). If the
+    storage is None, the codes are used as they were saved.
+    """
+    def _after_load(self, storage="float32", rerank=4):
+        self.rerank = rerank
+        self.target_storage = self.storage if storage is None else storage
+        if self.needs_build() and not self.read_only:
+            self.set_storage(storage)
+
+    # Returns True if the files of the index do not match the options it was loaded with yet
+    # (the codes of a read-only index, the structures of the subclasses, see build_structures()).
+    def needs_build(self):
+        return self.target_storage != self.storage
+
+    # Replaces the codes of the embeddings by the codes of the given type (only the codes and the header are written).
+    def set_storage(self, storage):
+        old_codes = self.header.get("codes")
+        self.configure_storage(storage, self.rerank)
+        self.header["codes"] = None
+        if storage != "float32":
+            slots = np.arange(self.header["count"])
+            self.header["codes"] = self._write_codes(self.directory, secrets.token_hex(8), slots)
+        self._write_header()
+        if old_codes is not None:
+            (self.directory / old_codes["file"]).unlink(missing_ok=True)
+        dirty = self._dirty
+        self._map(self.ids if self._ids_changed else None)
+        self._dirty = dirty
+
+    """
+    Compares the checksums stored in the header with the actual data. Reads
+    the whole matrix, so it is not done when loading the index.
+    """
+    def verify(self):
+        return self.checksums(self.data, self.ids, self.header["block_size"]) == self.header["checksums"]
+
+    """
+    Stores the paths and modified times of the images (aligned with the slots)
+    in the index, e.g. for an index created without them. Only the path table
+    and the header are written.
+    """
+    def set_paths(self, paths, mtimes):
+        self.paths = PathTable(paths, mtimes)
+        self.header["paths"] = self.paths.save(self.directory, secrets.token_hex(8))
+        self._write_header()
+
+    """
+    Appends the embeddings of new images with the given ids to the index.
+    If the index stores the paths, the paths and modified times of the images
+    must be given too. The embeddings are appended to the files, the ids are
+    kept in memory; nobody else sees the new images until flush() is called.
+    """
+    def add(self, ids, data, paths=None, mtimes=None):
+        ids = np.array(ids, dtype=np.int64).reshape(-1)
+        if len(ids) == 0:
+            return
+        data = self.normalize(data)
+        count, dim = self.header["count"], self.header["dim"]
+        if self.paths is not None:
+            if paths is None:
+                raise ValueError("The index stores the paths of the images, they must be given")
+            if len(paths) != len(ids):
+                raise ValueError("The number of paths and ids does not match")
+            self.paths.append(paths, mtimes)
+
+        # The files may be longer than the header says (e.g. after a failed refresh), the rows
+        # mapped by the other instances (up to `count`) are never overwritten
+        files = [(self._vectors_path(), data, 4 * dim)]
+        if self.codes is not None:
+            codes = self.encode(data)
+            files.append((self.directory / self.header["codes"]["file"], codes, codes.itemsize * dim))
+        for path, array, row_size in files:
+            with open(path, "r+b") as f:
+                f.truncate(count * row_size)
+                f.seek(count * row_size)
+                array.tofile(f)
+
+        all_ids = np.concatenate([np.asarray(self.ids), ids])
+        self.header["count"] = count + len(ids)
+        dirty = self._dirty
+        self._map(all_ids)
+        first, last = count // self.checksum_block_size, (count + len(ids) - 1) // self.checksum_block_size
+        self._dirty = dirty | set(range(first, last + 1))
+
+    """
+    Replaces the embeddings (and the modified times, if given) of the images
+    with the given ids. The images are moved to new slots (the old slots are
+    removed), so the rows mapped by the other instances are not overwritten.
+    """
+    def update(self, ids, data, mtimes=None):
+        ids = np.array(ids, dtype=np.int64).reshape(-1)
+        if len(ids) == 0:
+            return
+        slots = [self.slots[id] for id in ids.tolist()]
+        paths = None
+        if self.paths is not None:
+            paths = [self.paths.path(slot) for slot in slots]
+            if mtimes is None:
+                mtimes = [self.paths.mtime(slot) for slot in slots]
+        self.remove(ids)
+        self.add(ids, data, paths, mtimes)
+
+    # Removes the images with the given ids, i.e. marks their slots by tombstones (in memory, see flush()).
+    def remove(self, ids):
+        slots = [self.slots.pop(id) for id in np.reshape(ids, -1).tolist() if id in self.slots]
+        if len(slots) == 0:
+            return
+        slots = np.array(slots, dtype=np.int64)
+        if not self._ids_changed:
+            self.ids = np.array(self.ids, dtype=np.int64)
+            self._ids_changed = True
+        self.ids[slots] = -1
+        self.deleted += len(slots)
+        self.header["deleted"] = self.deleted
+        self._dirty.update((slots // self.checksum_block_size).tolist())
+
+    """
+    Publishes the changes made by add(), update() and remove(): writes the ids
+    to a new file, updates the checksums of the modified blocks and replaces
+    the header. The ids file of the previous version is removed (the
+    instances that still have it mapped keep their pages).
+    """
+    def flush(self):
+        old_ids = None
+        if self._ids_changed:
+            filename = f"ids-{secrets.token_hex(8)}.i64"
+            with open(self.directory / filename, "wb") as f:
+                np.asarray(self.ids, dtype=np.int64).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            old_ids = self._ids_path()
+            self.header["ids"] = filename
+        checksums = self.header["checksums"]
+        n_blocks = -(-self.header["count"] // self.checksum_block_size)
+        checksums.extend([None] * (n_blocks - len(checksums)))
+        for block in sorted(self._dirty):
+            start = block * self.checksum_block_size
+            checksums[block] = self.checksum(self.data, self.ids, start, start + self.checksum_block_size)
+        self._save_structures()
+        self._write_header()
+        if old_ids is not None:
+            old_ids.unlink(missing_ok=True)
+        self._map()
+
+    # Returns True if there are so many tombstones that the index should be compacted.
+    def needs_compaction(self):
+        return self.deleted > self.compact_threshold * self.data.shape[0]
+
+    # Rewrites the index without the removed slots. The ids of the images do not change.
+    def compact(self):
+        self._rewrite(self.directory, np.flatnonzero(self.ids >= 0))
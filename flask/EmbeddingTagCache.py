@@ -1,28 +1,83 @@
-from cachetools import TTLCache
-from settings import settings
-import sys
+import hashlib
+import io
 import secrets
+import sqlite3
+import threading
+import numpy as np
+from pathlib import Path
+from time import time
+from settings import settings
 
 """
 Caches embeddings for pairs (tag, session_id),
 i.e. each user has his own cached embeddings.
+
+The known session ids and the cached embeddings are stored in a small SQLite
+database, so all the server processes (SERVER_WORKERS > 1) share them: a
+session created by one process is valid in the others, and the tag of an
+image uploaded to one process can be served by any of them. The embeddings
+expire after TAG_EMBED_CACHE_TTL seconds, and only TAG_EMBED_CACHE_SIZE of
+the most recent ones are kept.
 """
 class EmbeddingTagCache:
-    def __init__(self):
-        self.cache = TTLCache(settings.TAG_EMBED_CACHE_SIZE, settings.TAG_EMBED_CACHE_TTL)
-    
-    @staticmethod
-    def get_full_tag(tag, session_id):
-        return session_id + "_" + tag
+    def __init__(self, path="instance/sessions.db"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # The other processes may hold the database locked for a short time
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS session (id TEXT PRIMARY KEY, created REAL NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tag ("
+                "session TEXT NOT NULL, tag TEXT NOT NULL, embedding BLOB NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (session, tag))"
+            )
 
+    # Returns True if the session id was given out by any of the server processes.
+    def has_session(self, session_id):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM session WHERE id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    # Creates a new random session id and returns it.
+    def new_session(self):
+        with self.lock, self.connection:
+            while True:
+                id = secrets.token_hex(16)
+                cursor = self.connection.execute("INSERT OR IGNORE INTO session (id, created) VALUES (?, ?)", (id, time()))
+                if cursor.rowcount == 1:
+                    return id
+
+    # Returns the cached embedding, raises KeyError if there is none (or it expired).
     def get(self, tag, session_id):
-        return self.cache[self.get_full_tag(tag, session_id)]
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT embedding FROM tag WHERE session = ? AND tag = ? AND expires > ?", (session_id, tag, time())
+            ).fetchone()
+        if row is None:
+            raise KeyError(tag)
+        return np.load(io.BytesIO(row[0]), allow_pickle=False)
 
+    # Caches the embedding for the session and returns its tag (the hash of the embedding).
     def add(self, embedding, session_id):
-        h = hash(embedding.tobytes())
-        if h < 0:
-            h += sys.maxsize+1
-        tag = hex(h)[2:]
-        full_tag = self.get_full_tag(tag, session_id)
-        self.cache[full_tag] = embedding
+        tag = hashlib.blake2b(np.ascontiguousarray(embedding).tobytes(), digest_size=8).hexdigest()
+        data = io.BytesIO()
+        np.save(data, embedding, allow_pickle=False)
+        now = time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tag (session, tag, embedding, expires) VALUES (?, ?, ?, ?)",
+                (session_id, tag, data.getvalue(), now + settings.TAG_EMBED_CACHE_TTL),
+            )
+            self.connection.execute("DELETE FROM tag WHERE expires <= ?", (now,))
+            self.connection.execute(
+                "DELETE FROM tag WHERE rowid NOT IN (SELECT rowid FROM tag ORDER BY expires DESC LIMIT ?)",
+                (settings.TAG_EMBED_CACHE_SIZE,),
+            )
         return tag
+
+    # Removes all the cached embeddings (the sessions stay valid).
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM tag")
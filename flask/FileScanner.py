@@ -0,0 +1,150 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+
+ScannedFile = namedtuple("ScannedFile", ["path", "mtime", "size"])
+
+"""
+Result of comparing the scanned files with the images in the database:
+ - added: paths of the files that are not in the database
+ - modified: pairs (image, timestamp) of the images whose file has a different modified time
+ - deleted: images whose file does not exist anymore
+ - unchanged: images whose file has not changed
+"""
+ScanDiff = namedtuple("ScanDiff", ["added", "modified", "deleted", "unchanged"])
+
+
+"""
+Recursive scanner of the image library based on `os.scandir`.
+
+Each directory is listed by a separate task of a thread pool, so on network
+file systems the latencies of listing many directories overlap. The files are
+filtered by their extension without regular expressions, and only the files
+that pass the filter are stat-ed (exactly once). Hidden files and directories
+(starting with a dot) are skipped, the same as `glob` does.
+"""
+class FileScanner:
+    def __init__(self, formats=None, workers=8):
+        self.formats = None if formats is None else {f.lower() for f in formats}
+        self.workers = max(1, workers)
+
+    # Returns True if the file name has one of the accepted extensions.
+    def accepts(self, name):
+        if self.formats is None:
+            return True
+        base, dot, extension = name.rpartition(".")
+        return dot != "" and extension.lower() in self.formats
+
+    # Lists one directory, returns the list of the accepted files and the list of subdirectories.
+    # A directory removed while scanning is empty.
+    def scan_directory(self, path):
+        files = []
+        directories = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            directories.append(entry.path)
+                        elif self.accepts(entry.name) and entry.is_file():
+                            stat = entry.stat()
+                            files.append(ScannedFile(entry.path, stat.st_mtime, stat.st_size))
+                    except OSError:
+                        # The entry was removed while scanning or is a broken symlink
+                        continue
+        except OSError:
+            pass
+        return files, directories
+
+    # Lists the directory unless it was already visited (through a symlink cycle), see scan_directory().
+    def scan_unvisited(self, path, visited, lock):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed while scanning
+            return [], []
+        with lock:
+            if (stat.st_dev, stat.st_ino) in visited:
+                return [], []
+            visited.add((stat.st_dev, stat.st_ino))
+        return self.scan_directory(path)
+
+    """
+    Scans the directory recursively. Returns a dictionary mapping the paths of
+    the accepted files (starting with the given root, as `glob` returns them)
+    to the ScannedFile tuples (path, mtime, size).
+    """
+    def scan(self, root):
+        root = os.path.normpath(root)
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f"No such directory: {root}")
+
+        result = {}
+        # Do not scan the same directory twice (symlink cycles), the directories are stat-ed by the workers
+        visited = set()
+        lock = threading.Lock()
+        with ThreadPoolExecutor(self.workers) as executor:
+            def submit(path):
+                pending.add(executor.submit(self.scan_unvisited, path, visited, lock))
+
+            pending = set()
+            submit(root)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, directories = future.result()
+                    for file in files:
+                        result[file.path] = file
+                    for directory in directories:
+                        submit(directory)
+        return result
+
+    """
+    Scans only the given paths (e.g. the paths reported by a DirectoryWatcher):
+    the files are stat-ed, the directories are scanned recursively, and the
+    paths that do not exist are skipped. Returns the same dictionary as scan().
+    """
+    def scan_paths(self, paths):
+        result = {}
+        for path in paths:
+            path = os.path.normpath(path)
+            if any(part.startswith(".") and part not in (".", "..") for part in path.split(os.sep)):
+                continue
+            try:
+                if os.path.isdir(path):
+                    result.update(self.scan(path))
+                elif self.accepts(os.path.basename(path)):
+                    stat = os.stat(path)
+                    result[path] = ScannedFile(path, stat.st_mtime, stat.st_size)
+            except OSError:
+                # Removed in the meantime
+                continue
+        return result
+
+    """
+    Compares the scanned files (returned by scan()) with the images from the
+    database (objects with the attributes path and timestamp). Returns the
+    ScanDiff tuple.
+    """
+    @staticmethod
+    def diff(files, images):
+        added = dict(files)
+        modified = []
+        deleted = []
+        unchanged = []
+        for img in images:
+            file = added.pop(img.path, None)
+            if file is None:
+                deleted.append(img)
+                continue
+            timestamp = datetime.fromtimestamp(file.mtime)
+            if img.timestamp != timestamp:
+                modified.append((img, timestamp))
+            else:
+                unchanged.append(img)
+        return ScanDiff(sorted(added), modified, deleted, unchanged)
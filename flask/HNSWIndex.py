@@ -0,0 +1,324 @@
+import numpy as np
+import os
+from heapq import heappush, heappop, heapify
+from math import log
+from EmbeddingIndex import EmbeddingIndex
+
+
+"""
+Approximate cosine similarity index with a hierarchical navigable small world
+(HNSW) graph.
+
+Each image is a node of a multi-layer proximity graph: all the nodes are in
+the bottom layer (with up to 2*M neighbours), and exponentially fewer nodes in
+each of the upper layers (with up to M neighbours). A query greedily descends
+from the top layer to the bottom one, where a best-first search with a list of
+`ef_search` candidates finds the nearest neighbours. Only a few hundred
+embeddings are compared with the query, so the latency is very low even for
+large libraries, at the cost of a slower build.
+
+Images are inserted incrementally. Removed images stay in the graph to keep it
+navigable, they are only left out of the results. The graph is saved to
+`hnsw.npz` next to the files of the underlying EmbeddingIndex. Until the
+graph matching the files is built (see build_structures()), all the images
+are compared with the queries.
+"""
+class HNSWIndex(EmbeddingIndex):
+    hnsw_filename = "hnsw.npz"
+    structure_filenames = (hnsw_filename,)
+    # Number of images inserted into the graph between the progress reports of build_structures()
+    build_block_size = 1024
+
+    def __init__(
+        self, data, ids=None, model_name=None, paths=None, mtimes=None, M=16, ef_construction=100, ef_search=64
+    ):
+        super().__init__(data, ids, model_name, paths, mtimes)
+        self.configure(M, ef_construction, ef_search)
+        self.layers = None
+
+    def configure(self, M, ef_construction, ef_search):
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1 / log(max(M, 2))
+        self.rng = np.random.default_rng(0)
+
+    def _after_load(self, M=16, ef_construction=100, ef_search=64):
+        self.configure(M, ef_construction, ef_search)
+        self.layers = None
+
+        try:
+            with np.load(self.directory / self.hnsw_filename) as hnsw:
+                # The graph is valid only for the same files of the index
+                if str(hnsw["vectors"]) == self.header["vectors"] and int(hnsw["M"]) == M:
+                    self.levels = hnsw["levels"]
+                    self.entry_point = int(hnsw["entry_point"])
+                    self.layers = [hnsw["layer0"]]
+                    for level in range(1, int(hnsw["max_level"]) + 1):
+                        nodes = hnsw[f"nodes{level}"]
+                        neighbours = hnsw[f"layer{level}"]
+                        self.layers.append(dict(zip(nodes.tolist(), neighbours)))
+        except (FileNotFoundError, KeyError, ValueError):
+            self.layers = None
+        if self.layers is not None and len(self.levels) > self.data.shape[0]:
+            # Saved by a flush whose header was not written (yet)
+            self.layers = None
+
+        if self.layers is None:
+            # Built by build_structures() or the next flush(), searched exhaustively until then
+            return
+
+        # Insert the images added after the graph was saved (e.g. when
+        # the application was interrupted)
+        self.insert(range(len(self.levels), self.data.shape[0]))
+
+    def needs_build(self):
+        return self.layers is None
+
+    # Returns the maximal number of neighbours of a node in the given layer.
+    def max_neighbours(self, level):
+        return 2 * self.M if level == 0 else self.M
+
+    # Returns the neighbours of the node in the given layer.
+    def neighbours(self, node, level):
+        row = self.layers[level][node] if level > 0 else self.layers[0][node]
+        return row[row >= 0]
+
+    # Returns the neighbours as a row of the layer, padded by -1.
+    def padded(self, neighbours, level):
+        row = np.full(self.max_neighbours(level), -1, dtype=np.int32)
+        row[: len(neighbours)] = neighbours
+        return row
+
+    def set_neighbours(self, node, level, neighbours):
+        self.layers[level][node] = self.padded(neighbours, level)
+
+    # Builds the graph from scratch by inserting all the images, yields after each block of them.
+    def build_blocks(self):
+        self.levels = np.empty(0, dtype=np.int8)
+        self.layers = [np.empty((0, self.max_neighbours(0)), dtype=np.int32)]
+        self.entry_point = -1
+        count = self.data.shape[0]
+        for start in range(0, count, self.build_block_size):
+            self.insert(range(start, min(start + self.build_block_size, count)))
+            yield
+
+    def build(self):
+        for _ in self.build_blocks():
+            pass
+
+    def build_structures(self):
+        yield from self.build_blocks()
+        self.save_hnsw()
+
+    def build_steps(self):
+        return -(-self.data.shape[0] // self.build_block_size)
+
+    """
+    Best-first search in one layer of the graph. Returns up to ef pairs
+    (distance, node) sorted by increasing cosine distance from the query.
+    """
+    def search_layer(self, query, entry_points, ef, level):
+        # Plain ndarray view of the memory-mapped data is much faster to index
+        data = np.asarray(self.data)
+        visited = set(entry_points)
+        distances = 1 - data[entry_points] @ query
+        candidates = list(zip(distances.tolist(), entry_points))
+        heapify(candidates)
+        results = [(-d, n) for d, n in candidates]
+        heapify(results)
+        while len(results) > ef:
+            heappop(results)
+
+        while candidates:
+            distance, node = heappop(candidates)
+            if distance > -results[0][0]:
+                break
+            neighbours = [n for n in self.neighbours(node, level).tolist() if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            distances = 1 - data[neighbours] @ query
+            for d, n in zip(distances.tolist(), neighbours):
+                if len(results) < ef or d < -results[0][0]:
+                    heappush(candidates, (d, n))
+                    heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heappop(results)
+
+        return sorted((-d, n) for d, n in results)
+
+    """
+    Selects up to m neighbours from the candidates (pairs (distance, node)
+    sorted by distance). A candidate is skipped if it is closer to an already
+    selected neighbour than to the base node, so the neighbours point to
+    different directions and the graph stays well connected.
+    """
+    def select_neighbours(self, candidates, m):
+        nodes = [n for _, n in candidates]
+        vectors = np.asarray(self.data)[nodes]
+        pairwise = 1 - vectors @ vectors.T
+        selected = []
+        for i, (distance, _) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            if selected and pairwise[i, selected].min() < distance:
+                continue
+            selected.append(i)
+        return [nodes[i] for i in selected]
+
+    # Adds the node to the neighbours of the other node, pruning them if there are too many.
+    def link(self, node, other, level):
+        neighbours = self.neighbours(other, level)
+        if len(neighbours) < self.max_neighbours(level):
+            self.set_neighbours(other, level, np.append(neighbours, node))
+            return
+        neighbours = np.append(neighbours, node)
+        distances = 1 - self.data[neighbours] @ self.data[other]
+        candidates = sorted(zip(distances.tolist(), neighbours.tolist()))
+        self.set_neighbours(other, level, self.select_neighbours(candidates, self.max_neighbours(level)))
+
+    # Connects the node (already present in self.levels) to the graph.
+    def connect(self, node):
+        query = np.asarray(self.data[node])
+        level = int(self.levels[node])
+        if self.entry_point < 0:
+            self.entry_point = node
+            return
+
+        entry_points = [self.entry_point]
+        max_level = int(self.levels[self.entry_point])
+        for l in range(max_level, level, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, l)[0][1]]
+        for l in range(min(level, max_level), -1, -1):
+            candidates = [c for c in self.search_layer(query, entry_points, self.ef_construction, l) if c[1] != node]
+            neighbours = self.select_neighbours(candidates, self.max_neighbours(l))
+            self.set_neighbours(node, l, neighbours)
+            for other in neighbours:
+                self.link(node, other, l)
+            entry_points = [n for _, n in candidates] or entry_points
+
+        if level > max_level:
+            self.entry_point = node
+
+    # Inserts the slots (appended to the index since the graph was built) into the graph.
+    def insert(self, slots):
+        slots = list(slots)
+        if not slots:
+            return
+        levels = np.minimum(
+            (-np.log(1 - self.rng.random(len(slots))) * self.level_mult).astype(np.int8), 16
+        )
+        self.levels = np.concatenate([self.levels, levels]).astype(np.int8)
+        self.layers[0] = np.concatenate(
+            [self.layers[0], np.full((len(slots), self.max_neighbours(0)), -1, dtype=np.int32)]
+        )
+        while len(self.layers) <= int(levels.max()):
+            self.layers.append({})
+        for node, level in zip(slots, levels.tolist()):
+            for l in range(1, level + 1):
+                self.set_neighbours(node, l, [])
+        for node in slots:
+            self.connect(node)
+
+    # Dumps the graph next to the index files.
+    def save_hnsw(self):
+        arrays = {
+            "vectors": self.header["vectors"],
+            "M": self.M,
+            "levels": self.levels,
+            "entry_point": self.entry_point,
+            "max_level": len(self.layers) - 1,
+            "layer0": self.layers[0],
+        }
+        for level in range(1, len(self.layers)):
+            nodes = sorted(self.layers[level])
+            arrays[f"nodes{level}"] = np.array(nodes, dtype=np.int64)
+            arrays[f"layer{level}"] = np.array(
+                [self.layers[level][n] for n in nodes], dtype=np.int32
+            ).reshape(len(nodes), self.M)
+        tmp = self.directory / (self.hnsw_filename + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self.directory / self.hnsw_filename)
+
+    """
+    Returns the k most similar images for each of the query vectors. The search
+    keeps max(ef_search, k) candidates; if some of the results were removed
+    from the index, the search is repeated with a larger list. If even the
+    whole reachable graph does not contain k images (or the graph is not built
+    yet), all the images are compared.
+    """
+    def search(self, queries, k=1):
+        queries = self.normalize(queries)
+        k = min(k, len(self))
+        if self.layers is None:
+            return super().search(queries, k)
+        if k <= 0 or self.entry_point < 0:
+            return super().search(queries, 0)
+
+        ids = np.asarray(self.ids)
+        result_scores = np.empty((queries.shape[0], k), dtype=np.float32)
+        result_ids = np.empty((queries.shape[0], k), dtype=np.int64)
+        for i, query in enumerate(queries):
+            entry_points = [self.entry_point]
+            for level in range(int(self.levels[self.entry_point]), 0, -1):
+                entry_points = [self.search_layer(query, entry_points, 1, level)[0][1]]
+
+            ef = max(self.ef_search, k)
+            while True:
+                results = [
+                    (d, n) for d, n in self.search_layer(query, entry_points, ef, 0) if ids[n] >= 0
+                ]
+                if len(results) >= k or ef >= self.data.shape[0]:
+                    break
+                ef *= 2
+            if len(results) < k:
+                # The graph got disconnected (e.g. by removing many images), search exhaustively
+                distances = 1 - np.asarray(self.data) @ query
+                distances[ids < 0] = np.inf
+                nodes = np.argsort(distances, kind="stable")[:k]
+                results = list(zip(distances[nodes].tolist(), nodes.tolist()))
+            results = results[:k]
+            result_scores[i, : len(results)] = [1 - d for d, _ in results]
+            result_ids[i, : len(results)] = ids[[n for _, n in results]]
+        return result_scores, result_ids
+
+    def add(self, ids, data, paths=None, mtimes=None):
+        count = self.data.shape[0]
+        super().add(ids, data, paths, mtimes)
+        if self.layers is not None:
+            self.insert(range(count, self.data.shape[0]))
+
+    # The graph of a rewritten index is remapped to the new slots, the removed nodes are left out.
+    def _save_structures(self, slots=None):
+        old_layers = self.layers
+        if old_layers is None:
+            print("Building the HNSW graph...")
+            self.build()
+        elif slots is not None:
+            new_slot = np.full(len(self.levels), -1, dtype=np.int32)
+            new_slot[slots] = np.arange(len(slots), dtype=np.int32)
+
+            def remap(row):
+                row = new_slot[row[row >= 0]]
+                return row[row >= 0]
+
+            self.levels = self.levels[slots]
+            layers = [np.full((len(slots), self.max_neighbours(0)), -1, dtype=np.int32)]
+            for node, row in enumerate(old_layers[0][slots]):
+                row = remap(row)
+                layers[0][node, : len(row)] = row
+            for level in range(1, len(old_layers)):
+                layers.append({})
+                for old_node, row in old_layers[level].items():
+                    if new_slot[old_node] >= 0:
+                        layers[level][int(new_slot[old_node])] = self.padded(remap(row), level)
+            self.layers = layers
+            while len(self.layers) > 1 and not self.layers[-1]:
+                self.layers.pop()
+            # Pick a new entry point if the old one was removed
+            self.entry_point = int(new_slot[self.entry_point]) if self.entry_point >= 0 else -1
+            if self.entry_point < 0 and len(slots) > 0:
+                self.entry_point = int(np.argmax(self.levels))
+        self.save_hnsw()
@@ -0,0 +1,191 @@
+import numpy as np
+import os
+from EmbeddingIndex import EmbeddingIndex
+
+
+"""
+Approximate cosine similarity index with an inverted file (IVF).
+
+A coarse quantizer (spherical k-means with `nlist` centroids) is trained on
+the stored embeddings and each image is assigned to the inverted list of its
+nearest centroid. A query is compared only with the images in the `nprobe`
+lists whose centroids are the most similar to the query, which trades a
+little recall for an order of magnitude lower latency on large libraries.
+
+The centroids and the list assignment of each slot are saved to `ivf.npz`
+next to the files of the underlying EmbeddingIndex. New and modified images
+are assigned to the nearest existing centroid; when the library grows to
+`retrain_factor` times the size the quantizer was trained on, it is trained
+again. Until the quantizer matching the files is trained (see
+build_structures()), all the images are compared with the queries.
+"""
+class IVFIndex(EmbeddingIndex):
+    ivf_filename = "ivf.npz"
+    structure_filenames = (ivf_filename,)
+    kmeans_iterations = 10
+    # Number of training points per centroid and the minimal average list size
+    kmeans_sample_size = 64
+    min_list_size = 39
+    retrain_factor = 2.0
+
+    def __init__(self, data, ids=None, model_name=None, paths=None, mtimes=None, nlist=1024, nprobe=16):
+        super().__init__(data, ids, model_name, paths, mtimes)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+
+    def _after_load(self, nlist=1024, nprobe=16):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+
+        try:
+            with np.load(self.directory / self.ivf_filename) as ivf:
+                # The lists are valid only for the same files of the index
+                if str(ivf["vectors"]) == self.header["vectors"] and int(ivf["nlist"]) == nlist:
+                    self.centroids = ivf["centroids"]
+                    self.trained_count = int(ivf["trained_count"])
+                    assignments = ivf["assignments"]
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+
+        if self.centroids is None:
+            # Trained by build_structures() or the next flush(), searched exhaustively until then
+            return
+
+        # Assign the images added after the lists were saved (e.g. when
+        # the application was interrupted)
+        count = self.data.shape[0]
+        if len(assignments) < count:
+            tail = self.assign(self.data[len(assignments):])
+            assignments = np.concatenate([assignments, tail])
+        self.assignments = assignments[:count].copy()
+        self.assignments[np.asarray(self.ids) < 0] = -1
+        self.build_lists()
+
+    def needs_build(self):
+        return self.centroids is None
+
+    # Returns the index of the most similar centroid for each of the rows.
+    def assign(self, data, centroids=None):
+        if centroids is None:
+            centroids = self.centroids
+        assignments = np.empty(data.shape[0], dtype=np.int32)
+        for start in range(0, data.shape[0], self.block_size):
+            block = np.asarray(data[start : start + self.block_size], dtype=np.float32)
+            assignments[start : start + self.block_size] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    """
+    Trains the coarse quantizer by spherical k-means on a sample of the stored
+    embeddings and assigns all the images to the inverted lists. The number of
+    lists is reduced for small libraries, so the lists are not almost empty.
+    """
+    def train(self):
+        live = np.flatnonzero(np.asarray(self.ids) >= 0)
+        nlist = max(1, min(self.nlist, len(live) // self.min_list_size))
+        rng = np.random.default_rng(0)
+        sample_size = min(len(live), nlist * self.kmeans_sample_size)
+        sample = np.sort(rng.choice(live, size=sample_size, replace=False))
+        x = np.asarray(self.data[sample], dtype=np.float32)
+
+        if len(x) > 0:
+            centroids = x[rng.choice(len(x), size=nlist, replace=False)].copy()
+        else:
+            centroids = np.zeros((1, self.data.shape[1]), dtype=np.float32)
+        for _ in range(self.kmeans_iterations if len(x) > 0 else 0):
+            assignments = self.assign(x, centroids)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=nlist)
+            nonempty = counts > 0
+            sums = np.add.reduceat(x[order], np.cumsum(counts)[nonempty] - counts[nonempty], axis=0)
+            centroids[nonempty] = self.normalize(sums)
+            # Move the empty centroids to random points
+            n_empty = np.count_nonzero(~nonempty)
+            if n_empty > 0:
+                centroids[~nonempty] = x[rng.choice(len(x), size=n_empty, replace=False)]
+
+        self.centroids = centroids
+        self.trained_count = len(live)
+        self.assignments = self.assign(self.data)
+        self.assignments[np.asarray(self.ids) < 0] = -1
+        self.build_lists()
+
+    # Builds the inverted lists, i.e. the slots sorted by their list and the
+    # offsets of the lists, from the assignments (tombstones are left out).
+    def build_lists(self):
+        live = np.flatnonzero(self.assignments >= 0)
+        self.lists = live[np.argsort(self.assignments[live], kind="stable")]
+        counts = np.bincount(self.assignments[live], minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    # Dumps the quantizer and the assignments next to the index files.
+    def save_ivf(self):
+        tmp = self.directory / (self.ivf_filename + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                vectors=self.header["vectors"],
+                nlist=self.nlist,
+                centroids=self.centroids,
+                assignments=self.assignments,
+                trained_count=self.trained_count,
+            )
+        os.replace(tmp, self.directory / self.ivf_filename)
+
+    """
+    Returns the k most similar images for each of the query vectors, searching
+    only the `nprobe` lists with the most similar centroids. If these lists
+    contain less than k images, more lists are probed. All the images are
+    compared until the quantizer is trained.
+    """
+    def search(self, queries, k=1):
+        queries = self.normalize(queries)
+        k = min(k, len(self))
+        if k <= 0 or self.centroids is None:
+            return super().search(queries, k)
+
+        probe_order = np.argsort(-(queries @ self.centroids.T), axis=1)
+        sizes = np.diff(self.offsets)
+        result_scores = np.empty((queries.shape[0], k), dtype=np.float32)
+        result_ids = np.empty((queries.shape[0], k), dtype=np.int64)
+        for i, (query, lists) in enumerate(zip(queries, probe_order)):
+            n_lists = max(self.nprobe, np.searchsorted(np.cumsum(sizes[lists]), k) + 1)
+            candidates = np.sort(np.concatenate(
+                [self.lists[self.offsets[l] : self.offsets[l + 1]] for l in lists[:n_lists]]
+            ))
+            scores = self.data[candidates] @ query
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                scores, candidates = scores[top], candidates[top]
+            order = np.argsort(-scores, kind="stable")
+            result_scores[i] = scores[order]
+            result_ids[i] = np.asarray(self.ids)[candidates[order]]
+        return result_scores, result_ids
+
+    def add(self, ids, data, paths=None, mtimes=None):
+        count = self.data.shape[0]
+        super().add(ids, data, paths, mtimes)
+        if self.centroids is not None:
+            self.assignments = np.concatenate([self.assignments, self.assign(self.data[count:])])
+            self.build_lists()
+
+    def remove(self, ids):
+        slots = [self.slots[id] for id in np.reshape(ids, -1).tolist() if id in self.slots]
+        super().remove(ids)
+        if self.centroids is not None:
+            self.assignments[slots] = -1
+            self.build_lists()
+
+    # The quantizer is trained again if the library grew, the lists of a rewritten index are reordered.
+    def _save_structures(self, slots=None):
+        if self.centroids is None:
+            print("Training the IVF index...")
+            self.train()
+        elif slots is not None:
+            self.assignments = self.assignments[slots]
+            self.build_lists()
+        elif len(self) > self.retrain_factor * max(self.trained_count, self.min_list_size):
+            print("Retraining the IVF index...")
+            self.train()
+        self.save_ivf()
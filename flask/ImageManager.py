@@ -4,23 +4,42 @@ import os
 import os.path
 import sys
 import pickle
-import PIL
-import re
+import copy
+import threading
+from glob import glob
+from contextlib import contextmanager
 import torch
-from itertools import count
+from collections import namedtuple
 from pathlib import Path
 from datetime import datetime
-from scipy.spatial import KDTree
-from glob import glob
 from models import db
 from CLIPWrapper import CLIPWrapper
+from EmbeddingIndex import EmbeddingIndex, IndexFormatError
+from IngestPipeline import IngestPipeline
+from IngestCheckpoint import IngestCheckpoint
+from InferenceExecutor import InferenceExecutor
+from EmbeddingCache import EmbeddingCache
+from TextEmbeddingCache import TextEmbeddingCache
+from ThumbnailCache import ThumbnailCache
+from FileScanner import FileScanner
+from IVFIndex import IVFIndex
+from HNSWIndex import HNSWIndex
+from NeighbourTable import NeighbourTable
+from ShardedSearch import ShardedSearch
 from tqdm import tqdm
 from utils import batched
 from settings import settings
 
 
+# Lightweight image returned by the queries, without a database session
+ImageRecord = namedtuple("ImageRecord", ["id", "path", "timestamp"])
+
+
 class ImageManager:
     image_formats = ["jpg", "jpeg", "png", "gif", "bmp", "ico", "tiff", "tga", "webp"]
+    index_types = {"flat": EmbeddingIndex, "ivf": IVFIndex, "hnsw": HNSWIndex}
+    # Number of images written to a new index at once (see create_index())
+    index_chunk_size = 16384
 
     def __init__(self, *, clip_wrapper=None, model_name="ViT-B/32", prefer_cuda=False):
         self.dir = os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -28,106 +47,487 @@ class ImageManager:
 
         if clip_wrapper is not None:
             self.clip = clip_wrapper
-        self.clip = CLIPWrapper.Create(model_name=model_name, prefer_cuda=prefer_cuda)
-        self.try_load_kdtree()
+        threads = settings.INFERENCE_THREADS
+        if threads <= 0 and settings.SERVER_WORKERS > 1:
+            # The cores are shared by the server processes
+            threads = max(1, InferenceExecutor.available_cores() // settings.SERVER_WORKERS)
+        # Batch size and threads measured for this model by `python benchmarks.py calibrate`, if any,
+        # looked up before the model is loaded so the exported encoders get the calibrated threads
+        device, precision, embedding_name = self.expected_embedding(model_name, prefer_cuda)
+        self.tuning = self.load_tuning(embedding_name, device)
+        if self.tuning is not None and settings.INFERENCE_THREADS <= 0:
+            threads = self.tuning["threads"] if threads <= 0 else min(threads, self.tuning["threads"])
+        self.clip = CLIPWrapper.Create(
+            model_name=model_name,
+            prefer_cuda=prefer_cuda,
+            backend=settings.INFERENCE_BACKEND,
+            threads=threads,
+            export_dir=settings.INFERENCE_EXPORT_DIR,
+            precision=precision,
+        )
+        # Identifies the embeddings in the index and the caches (the model name tagged by the precision mode)
+        self.embedding_name = self.clip.embedding_name
+        if self.load_tuning(self.embedding_name, self.clip.device) is not self.tuning:
+            # The model fell back to another precision mode or device than the calibrated one
+            self.tuning = None
+        self.inference = InferenceExecutor(
+            self.clip,
+            max_batch_size=settings.INFERENCE_MAX_BATCH_SIZE,
+            max_wait=settings.INFERENCE_MAX_WAIT_MS / 1000,
+            threads=threads,
+        )
+        self.embedding_cache = None
+        if settings.EMBEDDING_CACHE:
+            self.embedding_cache = EmbeddingCache(settings.EMBEDDING_CACHE_PATH, self.embedding_name)
+        self.thumbnails = None
+        if settings.THUMBNAILS:
+            self.thumbnails = ThumbnailCache(settings.THUMBNAIL_DIR, settings.THUMBNAIL_SIZE, settings.THUMBNAIL_QUALITY)
+        self.pipeline = IngestPipeline(
+            self.clip,
+            workers=settings.INGEST_WORKERS,
+            prefetch=settings.INGEST_PREFETCH,
+            cache=self.embedding_cache,
+            encoder=self.inference,
+            min_free_memory=settings.INGEST_MIN_FREE_MB * 2**20,
+            thumbnails=self.thumbnails,
+        )
+        self.text_cache = TextEmbeddingCache(
+            self.embedding_name,
+            max_size=settings.TEXT_CACHE_SIZE,
+            path=settings.TEXT_CACHE_PATH if settings.TEXT_CACHE_PERSIST else None,
+        )
+        self.scanner = FileScanner(self.image_formats, workers=settings.SCAN_WORKERS)
+        # Progress of an interrupted initialization of the library, see get_init_generators()
+        self.checkpoint = IngestCheckpoint(self.checkpoint_directory(), self.embedding_name)
+        self.neighbours = None
+        self.sharded = None
+        # Incremented whenever the index changes, see sync_index()
+        self.generation = 0
+        self.loaded_version = None
+        # Version of the files whose index structures were not built yet, see sync_index()
+        self.pending_version = None
+        self.sync_lock = threading.Lock()
+        # Held while the index and the table of the nearest neighbours are replaced together, see snapshot()
+        self.index_lock = threading.Lock()
+        # True while this process is changing the index, see updating_index()
+        self.updating = False
+        self.try_load_index()
+        self.update_shards()
+
+    """
+    Returns the triple (device, precision, embedding name) of the model with
+    the configured precision mode on the preferred device. It is known before
+    the model is loaded, e.g. to name the database of the images (each
+    embedding name has its own database, the same as its own index).
+    """
+    @staticmethod
+    def expected_embedding(model_name, prefer_cuda=False):
+        device = CLIPWrapper.select_device(prefer_cuda)
+        precision = CLIPWrapper.resolve_precision(settings.INFERENCE_PRECISION, settings.INFERENCE_BACKEND, device)
+        return device, precision, CLIPWrapper.tagged_name(model_name, precision)
+
+    # Returns the configuration measured by the calibration (see benchmarks.py) for the embedding name,
+    # backend and device, or None if it was not calibrated.
+    def load_tuning(self, embedding_name, device):
+        tuning = settings.INGEST_TUNING.get(embedding_name)
+        if tuning is None or tuning.get("backend") != settings.INFERENCE_BACKEND or tuning.get("device") != device:
+            return None
+        return tuning
+
+    # Returns the number of images embedded in one batch by the ingestion.
+    def batch_size(self):
+        if self.tuning is not None:
+            return self.tuning["batch_size"]
+        return settings.BATCH_SIZE
 
     # Returns all images in database
     def images(self):
         return db.session.query(models.Image)
 
-    # Returns result of the k-d tree query for the k nearest neighbours of the text embedding.
+    # Returns the k images most similar to the text.
     def query_text(self, text, k=1):
-        return self.query(self.clip.text2vec(text).cpu().numpy(), k=k)
+        return self.query(self.embed_text(text), k=k)
 
-    # Embeds the image and return result of the k-d tree query for the k nearest neighbours of the embedding.
+    # Embeds the image and returns the k most similar images.
     def query_image(self, image, k=1):
-        return self.query(self.clip.img2vec(image).cpu().numpy(), k=k)
+        return self.query(self.embed_image(image), k=k)
 
     # Embeds the image and returns the embedding
     def embed_image(self, image):
-        return self.clip.img2vec(image).cpu().numpy()
+        tensor = self.clip.preprocess_image(image).unsqueeze(0)
+        return self.inference.encode_images(tensor).numpy()
 
-    # Returns result of the k-d tree query for the k nearest neighbours of the image embedding given by it's databse id
-    def query_id(self, id, k=1):
-        return self.query(self.kdtree.data[id - 1], k=k)
+    # Embeds the text (or takes its embedding from the cache) and returns the embedding
+    def embed_text(self, text):
+        return self.text_cache.get_or_compute(text, lambda text: self.inference.encode_texts([text]).numpy())
 
-    # Returns result of the k-d tree query for the k nearest neighbours of the given embedding.
+    # Returns the k images most similar to the image given by it's databse id
+    def query_id(self, id, k=1):
+        snapshot = self.snapshot()
+        index = snapshot[0]
+        if id not in index:
+            return []
+        ids = self.neighbour_ids(id, snapshot)
+        if ids is not None and len(ids) >= k:
+            return self.records(ids[:k], index)
+        return self.query(index.vector(id), k=k)
+
+    # Returns the current index and its table of the nearest neighbours, which are replaced together
+    # when a new index is loaded or created (the ids of its images may differ).
+    def snapshot(self):
+        with self.index_lock:
+            return self.index, self.neighbours
+
+    # Returns the ids of the precomputed nearest neighbours of the image (without the removed ones),
+    # or None if the table of nearest neighbours is disabled or does not contain the image.
+    # The snapshot (see snapshot()) is the current one by default.
+    def neighbour_ids(self, id, snapshot=None):
+        index, neighbours = self.snapshot() if snapshot is None else snapshot
+        if neighbours is None:
+            return None
+        ids = neighbours.get(id)
+        if ids is None:
+            return None
+        return np.array([id for id in ids.tolist() if id in index], dtype=np.int64)
+
+    # Returns the k images most similar to the given embedding.
     def query(self, embedding, k=1):
-        indices = self.kdtree.query(embedding, k=k)[1].reshape(-1)
-        indices = 1 + indices[indices < self.kdtree.data.shape[0]]
-        db_query = models.Image.query.filter(
-            models.Image.id.in_(indices.tolist())
-        ).order_by(models.Image.id)
-        db_query = list(db_query)
+        return self.query_batch(np.reshape(embedding, (1, -1)), k=k)[0]
+
+    """
+    Returns the k most similar images for each row of the given matrix of
+    embeddings, i.e. a list of lists of ImageRecords. All the queries are
+    answered by a single search of the index, the paths of the images are read
+    from the path table of the index (the database is not queried at all).
+    """
+    def query_batch(self, embeddings, k=1):
+        ids = self.search(embeddings, k=k)[1]
+        return [self.records(row) for row in ids]
 
-        # wee need to order the results
-        order = dict(zip(indices, count()))
-        db_query.sort(key=lambda x: order[x.id])
-        return db_query
+    # Returns the ids of the k images most similar to the given embedding.
+    def query_ids(self, embedding, k=1):
+        return self.search(np.reshape(embedding, (1, -1)), k=k)[1][0]
 
+    # Searches the index (by the shard workers, if they are running), see EmbeddingIndex.search().
+    def search(self, embeddings, k=1):
+        self.sync_index()
+        if self.sharded is not None:
+            return self.sharded.search(embeddings, k=k)
+        return self.index.search(embeddings, k=k)
 
     """
-    Creates a k-d tree from the given data, saves it in self.kdtree, and dumps
-    it to the disk.
+    Starts the worker processes searching the shards of the index (or makes
+    them reload the index after it was changed), if SHARD_COUNT is larger than
+    1. Only the exact ("flat") index can be sharded.
     """
-    def create_kdtree(self, data):
-        filename = f"kdtrees/kdtree_{self.model_name.replace('/','-')}.pkl"
-        kdtree = KDTree(data)
-        with open(filename, "wb") as f:
-            pickle.dump(kdtree, f)
-        self.kdtree = kdtree
+    def update_shards(self):
+        if settings.SHARD_COUNT <= 1 or settings.INDEX_TYPE != "flat" or self.index is None:
+            return
+        if self.sharded is None:
+            _, options = self.index_type()
+            # The cores are shared by the shards (of all the server processes)
+            threads = max(1, InferenceExecutor.available_cores() // (settings.SHARD_COUNT * max(1, settings.SERVER_WORKERS)))
+            self.sharded = ShardedSearch(
+                self.index_directory(), self.embedding_name, settings.SHARD_COUNT, options, threads=threads
+            )
+        else:
+            self.sharded.reload()
+
+    # Returns the ImageRecords of the images with the given ids (skipping the ones not in the index).
+    # The images removed from the index (e.g. by a refresh finished after the search) are skipped.
+    def records(self, ids, index=None):
+        if index is None:
+            index = self.index
+        return [self.image_record(id, index) for id in np.reshape(ids, -1).tolist() if id in index]
+
+    # Returns the ImageRecord of the image with the given id from the index (the current one by default).
+    def image_record(self, id, index=None):
+        if index is None:
+            index = self.index
+        path, mtime = index.path(id)
+        return ImageRecord(id, path, datetime.fromtimestamp(mtime))
+
+    # Returns the directory of the index for the current model.
+    def index_directory(self):
+        return f"kdtrees/{self.embedding_name.replace('/','-')}"
+
+    # Returns the directory of the checkpoint of the initialization for the current model.
+    def checkpoint_directory(self):
+        return os.path.join(settings.INGEST_CHECKPOINT_DIR, self.embedding_name.replace('/','-'))
+
+    # Returns the version of the index files (the header, the table of the nearest neighbours
+    # and the structures of the index type) on the disk.
+    def index_version(self):
+        index_class, _ = self.index_type()
+        version = []
+        filenames = (EmbeddingIndex.header_filename, NeighbourTable.header_filename) + index_class.structure_filenames
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(self.index_directory(), filename))
+                version.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    # Called after the index (or the table of the nearest neighbours) was changed on the disk by this process.
+    def index_saved(self):
+        self.loaded_version = self.index_version()
+        self.generation += 1
+        self.update_shards()
+
+    # Called after only the table of the nearest neighbours was changed on the disk by this process
+    # (the index and its shards stay the same).
+    def neighbours_saved(self):
+        self.loaded_version = self.index_version()
+        self.generation += 1
 
     """
-    Tries to load the k-d tree from the disk. If the file is not found,
-    the k-d tree is set to None and False is returned.
+    Reloads the index and the table of the nearest neighbours if they were
+    changed on the disk by another process of the server (SERVER_WORKERS > 1),
+    returns True if they were reloaded. If only the table was changed, the
+    index (and its shards) is kept. The files of the index are replaced
+    atomically (only the header refers to the current files), and the old
+    files stay mapped until the old index is released. The index is loaded
+    read-only, only the process changing it builds its structures; until
+    they match the new files, the current index is kept.
     """
-    def try_load_kdtree(self):
-        filename = f"kdtrees/kdtree_{self.model_name.replace('/','-')}.pkl"
-        if Path(filename).is_file():
-            with open(filename, "rb") as f:
-                self.kdtree = pickle.load(f)
-            print(f"Successfully loaded {filename}.")
+    def sync_index(self):
+        if settings.SERVER_WORKERS <= 1 or self.updating or self.index_version() in (self.loaded_version, self.pending_version):
+            return False
+        with self.sync_lock:
+            version = self.index_version()
+            if version in (self.loaded_version, self.pending_version):
+                return False
+            index = self.index
+            reload_index = (
+                self.loaded_version is None
+                or version[0] != self.loaded_version[0]
+                or version[2:] != self.loaded_version[2:]
+            )
+            if reload_index:
+                index_class, options = self.index_type()
+                try:
+                    index = index_class.load(self.index_directory(), self.embedding_name, read_only=True, **options)
+                except (FileNotFoundError, IndexFormatError):
+                    # Not written yet, keep the current one
+                    return False
+                if index.needs_build() and self.index is not None:
+                    # The structures are being built by the other process, keep the current one
+                    self.pending_version = version
+                    return False
+            neighbours = None
+            if settings.KNN_TABLE:
+                neighbours = NeighbourTable.load(self.index_directory(), settings.KNN_SIZE)
+            with self.index_lock:
+                self.index, self.neighbours = index, neighbours
+            self.loaded_version = version
+            self.generation += 1
+            if reload_index:
+                self.update_shards()
+            print(f"Reloaded {self.index_directory()} (changed by another process).")
+            return True
+
+    # Returns the index class selected by settings.INDEX_TYPE and its keyword arguments.
+    def index_type(self):
+        if settings.INDEX_TYPE not in self.index_types:
+            raise ValueError(f"Unknown index type: {settings.INDEX_TYPE}")
+        options = {}
+        if settings.INDEX_TYPE == "flat":
+            options = {"storage": settings.EMBEDDING_STORAGE, "rerank": settings.EMBEDDING_RERANK}
+        elif settings.INDEX_TYPE == "ivf":
+            options = {"nlist": settings.IVF_NLIST, "nprobe": settings.IVF_NPROBE}
+        elif settings.INDEX_TYPE == "hnsw":
+            options = {
+                "M": settings.HNSW_M,
+                "ef_construction": settings.HNSW_EF_CONSTRUCTION,
+                "ef_search": settings.HNSW_EF_SEARCH,
+            }
+        return self.index_types[settings.INDEX_TYPE], options
+
+    """
+    Creates an index from the given data (and database ids, paths and modified
+    times of the images), saves it in self.index, and dumps it to the disk.
+    If the paths are not given, they are read from the database. The data
+    (e.g. memory-mapped) are written to the index in chunks, so the whole
+    matrix is never copied into the memory.
+    """
+    def create_index(self, data, ids=None, paths=None, mtimes=None):
+        index_class, options = self.index_type()
+        if ids is None:
+            ids = np.arange(1, len(data) + 1)
+
+        def chunks():
+            for start in range(0, len(ids), self.index_chunk_size):
+                stop = start + self.index_chunk_size
+                chunk_ids = np.asarray(ids[start:stop])
+                if paths is None:
+                    chunk_paths, chunk_mtimes = self.database_paths(chunk_ids.tolist())
+                else:
+                    chunk_paths = paths[start:stop]
+                    chunk_mtimes = None if mtimes is None else mtimes[start:stop]
+                yield chunk_ids, data[start:stop], chunk_paths, chunk_mtimes
+
+        dim = np.shape(data)[1] if np.ndim(data) == 2 else 0
+        index = index_class.create(self.index_directory(), chunks(), dim, model_name=self.embedding_name, **options)
+        # The nearest neighbours of the previous index are not valid anymore (the ids may restart
+        # from 1), they are dropped together with it
+        NeighbourTable.delete(self.index_directory())
+        with self.index_lock:
+            self.index, self.neighbours = index, None
+        self.index_saved()
+
+    """
+    Context of the actions changing the index (see get_refresh_generators()) run
+    by this process: the index is synchronized with the disk first, and it is
+    not reloaded by the queries (see sync_index()) until the actions finish.
+    """
+    @contextmanager
+    def updating_index(self):
+        self.sync_index()
+        self.updating = True
+        try:
+            yield
+        finally:
+            self.updating = False
+
+    """
+    Returns a new instance of the index loaded from the disk. The refresh
+    changes this instance while the queries keep using the current one, and
+    then it replaces the current one. The instances share the files, but the
+    rows mapped by the current instance are never changed: the new and
+    modified images are appended behind them, the tombstones are kept in the
+    memory of the new instance until it writes its own ids file (see
+    EmbeddingIndex.flush()), and the files replaced by the compaction stay
+    mapped until the current instance is released.
+    """
+    def load_index_copy(self):
+        index_class, options = self.index_type()
+        return index_class.load(self.index_directory(), self.embedding_name, **options)
+
+    """
+    Tries to load the index from the disk. If it is not found, tries to
+    convert the k-d tree pickled by the older versions of the application.
+    If neither is found, the index is set to None and False is returned.
+    The index is loaded read-only, its structures that do not match the files
+    are built in the background (see get_build_generators()).
+    """
+    def try_load_index(self):
+        directory = self.index_directory()
+        legacy_filename = f"kdtrees/kdtree_{self.model_name.replace('/','-')}.pkl"
+        index_class, options = self.index_type()
+        try:
+            self.index = index_class.load(directory, self.embedding_name, read_only=True, **options)
+            print(f"Successfully loaded {directory}.")
+            # Indexes created by the older versions do not store the paths
+            if self.index.paths is None:
+                self.index.set_paths(*self.database_paths(np.asarray(self.index.ids).tolist()))
+            if settings.KNN_TABLE:
+                self.neighbours = NeighbourTable.load(directory, settings.KNN_SIZE)
+            self.loaded_version = self.index_version()
+            return True
+        except FileNotFoundError:
+            pass
+        except IndexFormatError as e:
+            print(f"Warning: {e}")
+
+        # The old versions computed the embeddings only in the full precision
+        if Path(legacy_filename).is_file() and self.embedding_name == self.model_name:
+            with open(legacy_filename, "rb") as f:
+                kdtree = pickle.load(f)
+            self.create_index(kdtree.data)
+            print(f"Successfully converted {legacy_filename} to {directory}.")
             return True
         else:
-            print(f"Warning: '{filename}' not found!")
-            self.kdtree = None
+            print(f"Warning: '{directory}' not found!")
+            self.index = None
             return False
 
+    """
+    Returns the generator of the actions (see get_refresh_generators()) that
+    builds the structures of the index that do not match its files yet (e.g.
+    the HNSW graph after the index type was changed) and publishes them. The
+    current index answers the queries (exhaustively) until then.
+    """
+    def get_build_generators(self):
+        if self.index is None or not self.index.needs_build():
+            return
+        index = self.load_index_copy()
+        def build():
+            yield from index.build_structures()
+            self.index = index
+            self.index_saved()
+        steps = index.build_steps()
+        print("Building the index structures:")
+        yield tqdm(build(), total=steps, ncols=100), steps, "Building the index..."
+
+    """
+    Returns the generator of the actions (see get_refresh_generators()) that
+    updates the table of the nearest neighbours after the images with the
+    given ids were added or modified (and drops the removed ones). If there is
+    no table yet, or the ids are None, it is computed for the whole library.
+    Does nothing if the table is disabled.
+    """
+    def get_neighbour_generators(self, ids=None):
+        if not settings.KNN_TABLE or self.index is None:
+            return
+        if self.neighbours is None or ids is None:
+            table = NeighbourTable(self.index_directory(), settings.KNN_SIZE)
+            def build():
+                yield from table.build(self.index, settings.KNN_MEMORY_MB)
+                self.neighbours = table
+                self.neighbours_saved()
+            steps = table.build_steps(self.index, settings.KNN_MEMORY_MB)
+            yield build(), steps, "Computing nearest neighbours..."
+        else:
+            # The table used by the queries is replaced only when the update is done
+            table = copy.copy(self.neighbours)
+            def update():
+                yield
+                table.update(self.index, ids, settings.KNN_MEMORY_MB)
+                self.neighbours = table
+                self.neighbours_saved()
+            yield update(), -1, "Updating nearest neighbours..."
+
+    # Returns the lists of paths and modified times of the images given by ids from the database.
+    def database_paths(self, ids):
+        rows = {row.id: row for row in models.select_images_by_ids(ids)}
+        paths = [rows[id].path if id in rows else "" for id in ids]
+        mtimes = [rows[id].timestamp.timestamp() if id in rows else 0.0 for id in ids]
+        return paths, mtimes
+
     # Returns the embedding of the image given by path.
     def get_embedding(self, path):
-        with PIL.Image.open(path) as img:
-            return self.clip.img2vec(img)
+        return self.get_embeddings([path])
     
+    # Returns the embeddings of the images given by paths.
     def get_embeddings(self, paths):
-        data = []
+        return next(self.pipeline.embed([paths]))[1]
 
-        for path in paths:
-            with PIL.Image.open(path) as img:
-                img.load()
-                data.append(img)
-
-        return self.clip.imgs2vec(data)
-
-    # Clears the databse and kd-tree, and returns the action (generator) that
-    # rebuilds the database and the k-d tree from scratch.
+    # Clears the databse, and returns the action (generator) that rebuilds the database and the
+    # index from scratch. The current index answers the queries until the new one replaces it.
+    # An interrupted rebuild is resumed instead (the database is not cleared).
     def get_full_refresh_generators(self):
-        self.clear_all()
+        if not self.checkpoint.exists():
+            self.clear_database()
         yield from self.get_init_generators()
 
-    # Clears the database and the k-d tree, and rebuilds them from scratch by calling self.init().
+    # Clears the database and the index, and rebuilds them from scratch by calling self.init()
+    # (or resumes the interrupted rebuild).
     def full_refresh(self):
-        self.clear_all()
+        if not self.checkpoint.exists():
+            self.clear_all()
         self.init()
 
 
     """
-    Refreshes the database and the k-d tree by executing the generators returned
+    Refreshes the database and the index by executing the generators returned
     by get_refresh_generators(). Non-existing images are removed from the databse,
-    modified images are updated, and new images are added to the database. The k-d
-    tree is rebuilt from scratch.
+    modified images are updated, and new images are added to the database. Only
+    the changed images are touched, the index is updated in place. If paths
+    are given, only these files and directories are scanned.
     """
-    def refresh(self):
-        for gen, n, description in self.get_refresh_generators():
+    def refresh(self, paths=None):
+        for gen, n, description in self.get_refresh_generators(paths):
             for _ in gen: # Execute the generator, ignore the outputs (None)
                 pass
 
@@ -142,77 +542,138 @@ class ImageManager:
     having to know the details of each action, or the action having the know the
     implementation of the progressbar.
     """
-    def get_refresh_generators(self):
+    def get_refresh_generators(self, paths=None):
+        # The index is updated in place, it must be the one last saved by any process
+        self.sync_index()
+        if self.index is None:
+            if paths is None:
+                yield from self.get_full_refresh_generators()
+            return
+        current = self.index
         ########################
-        def update_images(imgs):
-            print("Adding and updating old images:")
-            for i, old_img in enumerate(imgs):
+        updated = []
+        updated_data = []
+        def update_images(modified):
+            print("Updating modified images:")
+            for batch, embeddings in self.pipeline.embed(modified, path=lambda x: x[0].path):
                 yield
-                new_img = self.insert_image(old_img.path)
-                if old_img.timestamp != new_img.timestamp:
-                    old_data[i] = self.get_embedding(new_img.path)
+                updated.extend((img.id, timestamp) for img, timestamp in batch)
+                updated_data.append(embeddings)
         ########################
+        new_rows = []
         new_data = []
         def add_images(missing):
             print("Adding new images:")
-            for batch in missing:
+            for batch, embeddings in self.pipeline.embed(missing):
                 yield
-                for file in batch:
-                    self.insert_image(file)
-                embeddings = self.get_embeddings(batch)
+                new_rows.extend((file, datetime.fromtimestamp(files[file].mtime)) for file in batch)
                 new_data.append(embeddings)
         ########################
+        changed_ids = []
         def finish():
-            nonlocal new_data, old_data
+            nonlocal index
             yield
-            if len(new_data) == 0:
-                data = old_data
-            else:
-                new_data = torch.cat(new_data).cpu().numpy()
-                if old_data is not None:
-                    data = np.concatenate([old_data, new_data], axis=0)
-                else:
-                    data = new_data
+            # The modified embeddings are written before the commit (if it fails, the
+            # unpublished index is dropped and the images are re-embedded by the next
+            # refresh again), the new and removed images only after the commit (their
+            # ids must be final)
+            if len(updated_data) > 0:
+                updated_ids = [id for id, _ in updated]
+                updated_mtimes = [timestamp.timestamp() for _, timestamp in updated]
+                index.update(updated_ids, torch.cat(updated_data).cpu().numpy(), updated_mtimes)
             try:
+                models.update_timestamps(updated)
+                models.delete_images(removed_ids)
+                new_ids = models.insert_images(new_rows)
                 db.session.commit()
-                print("Building k-d tree")
-                self.create_kdtree(data)
+                changed_ids.extend(new_ids + [id for id, _ in updated])
             except Exception as e:
                 db.session.rollback()
-                raise 
-        ########################
-        
-        dir = settings.DB_IMAGES_ROOT
-
-        # Find missing files and files that are already present
-        db_paths = set(map(lambda x: x.path, self.images()))
-        dir_paths = set(self.find_images(dir))
+                raise e
 
-        missing = dir_paths - db_paths
-        intersection = db_paths.intersection(dir_paths)
-        intersection = list(
-            models.Image.query.filter(models.Image.path.in_(intersection))
-        )
-        ids = list(map(lambda x: x.id - 1, intersection))
+            print("Updating index")
+            index.remove(removed_ids + orphan_ids)
+            if len(new_data) > 0:
+                index.add(
+                    new_ids,
+                    torch.cat(new_data).cpu().numpy(),
+                    paths=[path for path, _ in new_rows],
+                    mtimes=[timestamp.timestamp() for _, timestamp in new_rows],
+                )
+            # Nothing is published before the header is replaced by flush(), if the refresh fails
+            # until then, the current index stays (the appended rows are truncated by the next one)
+            index.flush()
+            if index.needs_compaction():
+                print("Compacting index")
+                try:
+                    index.compact()
+                except Exception as e:
+                    # The flushed index is valid, it is compacted by the next refresh
+                    print(f"Warning: compacting the index failed: {e!r}")
+                    index = self.load_index_copy()
+            # Publish the new index, the current one is released when the queries using it finish
+            self.index = index
+            self.index_saved()
+        ########################
 
-        # Clear the old databse
-        if self.kdtree is not None:
-            old_data = self.kdtree.data[ids]
+        # Find new, deleted and modified images by comparing the modified times
+        # from a single scan of the library with the timestamps in the database
+        if paths is None:
+            files = self.scanner.scan(settings.DB_IMAGES_ROOT)
+            diff = self.scanner.diff(files, models.select_images())
         else:
-            old_data = None
-        self.clear_all()
-
-        # Add old images to the database and update the embeddings if necessary
-        imgs = tqdm(list(intersection), ncols=100)
-        yield update_images(imgs), len(imgs), "Updating old images..."
+            # Only the given files and directories (e.g. reported by the DirectoryWatcher)
+            files = self.scanner.scan_paths(paths)
+            diff = self.scanner.diff(files, models.select_images_by_paths(paths))
+        removed_ids = [img.id for img in diff.deleted]
+        modified = []
+        missing = set(diff.added)
+
+        # The images missing in the index (e.g. when the application was
+        # interrupted while updating it) are removed and added again as new images.
+        for img, timestamp in diff.modified:
+            if img.id in current:
+                modified.append((img, timestamp))
+            else:
+                removed_ids.append(img.id)
+                missing.add(img.path)
+        for img in diff.unchanged:
+            if img.id not in current:
+                removed_ids.append(img.id)
+                missing.add(img.path)
+            elif current.paths is not None and current.path(img.id)[1] != img.timestamp.timestamp():
+                # The database was updated, but the index was not (the refresh failed after the commit)
+                modified.append((img, img.timestamp))
+
+        # Images in the index that are not in the database anymore (known only after scanning all of them)
+        orphan_ids = []
+        if paths is None:
+            db_ids = {img.id for img in diff.deleted + diff.unchanged}
+            db_ids.update(img.id for img, _ in diff.modified)
+            orphan_ids = list(set(current.slots) - db_ids)
+
+        if not (modified or missing or removed_ids or orphan_ids):
+            print("No changes found")
+            return
+
+        # The changes are made in a new instance of the index, which replaces the current one when they are done
+        index = self.load_index_copy()
+
+        # Update the embeddings of the modified images
+        modified = tqdm(list(batched(modified, k=self.batch_size())), ncols=100)
+        yield update_images(modified), len(modified), "Updating modified images..."
 
         # Add new images to the databse
-        missing = tqdm(list(batched(list(missing), k=settings.BATCH_SIZE)), ncols=100)
+        missing = tqdm(list(batched(sorted(missing), k=self.batch_size())), ncols=100)
         yield add_images(missing), len(missing), "Adding new images..."
 
-        # Commit the changes to the database and rebuild the k-d tree
+        # Commit the changes to the database and update the index
         yield finish(), -1, "Finishing up"
 
+        # Update the precomputed nearest neighbours of the changed images
+        if len(changed_ids) > 0 or len(removed_ids) + len(orphan_ids) > 0:
+            yield from self.get_neighbour_generators(changed_ids)
+
 
     """
     Returns a generator with a sequence of actions. Each action is a tuple of
@@ -226,50 +687,73 @@ class ImageManager:
     implementation of the progressbar.
     """
     def get_init_generators(self):
+        checkpoint = self.checkpoint
+        files = checkpoint.resume()
+        if files is None:
+            # Find images
+            scanned = self.scanner.scan(settings.DB_IMAGES_ROOT)
+            files = [(path, scanned[path].mtime) for path in sorted(scanned)]
+            checkpoint.start(files, models.max_image_id())
+        else:
+            print(f"Resuming the initialization: {checkpoint.position} of {len(files)} images done")
+            try:
+                # The rows of the chunk that was interrupted
+                models.delete_images_after(checkpoint.last_id)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                raise e
         ########################
-        data = None
-        def add_images(paths):
-            nonlocal data
+        def save_chunk(rows, vectors, position):
+            try:
+                ids = models.insert_images([(path, datetime.fromtimestamp(mtime)) for _, path, mtime in rows])
+                checkpoint.append(ids, torch.cat(vectors).cpu().numpy())
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                raise e
+            checkpoint.commit(position, len(ids), ids[-1])
+        ########################
+        def add_images(batches):
             print("Adding new images:")
+            rows = []
             vectors = []
-
-            for batch in paths:
+            for batch, embeddings in self.pipeline.embed(batches, path=lambda x: x[1]):
                 yield
-                for file in batch:
-                    self.insert_image(file)
-                embeddings = self.get_embeddings(batch)
+                rows.extend(batch)
                 vectors.append(embeddings)
-            """
-            for file in paths:
-                yield
-                self.insert_image(file)
-                embedding = self.get_embedding(file)
-                vectors.append(embedding)
-            """
-            data = torch.cat(vectors).cpu().numpy()
+                # Only the current chunk is kept in the memory
+                if len(rows) >= settings.INGEST_CHECKPOINT_SIZE:
+                    save_chunk(rows, vectors, rows[-1][0] + 1)
+                    rows, vectors = [], []
+            if rows:
+                save_chunk(rows, vectors, rows[-1][0] + 1)
         ########################
         def finish():
-            nonlocal data
             yield
-            try:
-                db.session.commit()
-                print("Building k-d tree")
-                self.create_kdtree(data)
-            except Exception as e:
-                db.session.rollback()
-                raise e
+            print("Building index")
+            ids, data = checkpoint.data()
+            self.create_index(data, ids)
+            checkpoint.delete()
         ########################
-        
-        # Find images
-        paths = tqdm(list(batched(list(self.find_images(settings.DB_IMAGES_ROOT)), k=settings.BATCH_SIZE)))
-        # Add images to the databse
-        yield add_images(paths), len(paths), "Adding new images..."
-        # Commit and build the k-d tree
+
+        # The images not processed yet (the ones removed in the meantime are skipped)
+        remaining = [
+            (position, path, mtime)
+            for position, (path, mtime) in enumerate(files[checkpoint.position:], checkpoint.position)
+            if checkpoint.position == 0 or os.path.isfile(path)
+        ]
+        batches = tqdm(list(batched(remaining, k=self.batch_size())))
+        # Add images to the databse, in durable chunks
+        yield add_images(batches), len(batches), "Adding new images..."
+        # Build the index
         yield finish(), -1, "Finishing up"
+        # Compute the nearest neighbours of all the images
+        yield from self.get_neighbour_generators()
 
 
     """
-    Inits the database and the k-d tree from scratch by executing
+    Inits the database and the index from scratch by executing
     the generators returned by get_init_generators().
     """
     def init(self):
@@ -282,18 +766,28 @@ class ImageManager:
         img = models.Image.query.filter_by(path=path).first()
         return self.update(img)
 
-    """
-    Clears the databse and the k-d tree.
-    """
-    def clear_all(self):
-        self.images().delete()
+    # Removes all the images from the database.
+    def clear_database(self):
         try:
+            models.delete_all_images()
             db.session.commit()
-            self.kdtree = None
         except Exception as e:
             db.session.rollback()
             raise e
 
+    """
+    Clears the databse and the index.
+    """
+    def clear_all(self):
+        self.clear_database()
+        with self.index_lock:
+            self.index, self.neighbours = None, None
+        self.generation += 1
+        if self.sharded is not None:
+            self.sharded.close()
+            self.sharded = None
+        NeighbourTable.delete(self.index_directory())
+
     # Finds and returns the images within the given directory (recursively).
     # The supported image formats are specified in the class variable image_formats.
     def find_images(self, path, abs_path=False, return_str=True):
@@ -301,28 +795,29 @@ class ImageManager:
             path, abs_path, formats=self.image_formats, return_str=return_str
         )
 
-    # Finds and returns the files within the given directory (recursively).
+    # Finds and returns the files within the given directory (recursively). If the formats
+    # are not given, all the files and the directories are returned (the same as by glob).
     def find_files(self, path, abs_path=False, formats=None, return_str=True):
         path = Path(path)
         if not path.is_dir():
-            raise FileNotFoundError("No such directory: {path}")
-
+            raise FileNotFoundError(f"No such directory: {path}")
         if abs_path:
             path = path.resolve()
 
         if formats is None:
-            for file in glob(str(path / "**"), recursive=True):
-                yield (str(file) if return_str else file)
+            files = glob(str(path / "**"), recursive=True)
         else:
-            r = re.compile(".*\.(" + "|".join(formats) + ")$", re.IGNORECASE)
-            for file in glob(str(path / "**"), recursive=True):
-                if r.search(str(file)):
-                    yield (str(file) if return_str else file)
-
-    # Inserts an image given by the path into the database with the modified time as the timestamp.
-    # Does not commit the changes, nor modify the k-d tree.
-    def insert_image(self, path):
-        timestamp = datetime.fromtimestamp(os.path.getmtime(path))
+            files = sorted(FileScanner(formats, workers=settings.SCAN_WORKERS).scan(path))
+        for file in files:
+            yield (file if return_str else Path(file))
+
+    # Inserts an image given by the path into the database with the modified time
+    # (if not given, it is read from the file) as the timestamp.
+    # Does not commit the changes, nor modify the index.
+    def insert_image(self, path, mtime=None):
+        if mtime is None:
+            mtime = os.path.getmtime(path)
+        timestamp = datetime.fromtimestamp(mtime)
         img = models.Image(path=path, timestamp=timestamp)
         db.session.add(img)
         return img
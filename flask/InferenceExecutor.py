@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+import torch
+from concurrent.futures import Future
+from time import monotonic
+
+
+"""
+Runs all the inference of the CLIP model in a single thread.
+
+The server threads (and the ingestion pipeline) only submit the texts or the
+preprocessed images and wait for the futures. The inference thread collects
+the requests arriving within `max_wait` seconds of the first one (up to
+`max_batch_size` items) into one micro-batch for each kind of input, runs the
+model once per kind and completes the futures. Concurrent queries thus share
+one forward pass instead of competing for the intra-op threads of torch, and
+the number of these threads can be set for the whole machine.
+"""
+class InferenceExecutor:
+    def __init__(self, clip, max_batch_size=32, max_wait=0.005, threads=0):
+        self.clip = clip
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.configure_threads(threads)
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="InferenceExecutor", daemon=True)
+        self.thread.start()
+
+    """
+    Sets the number of intra-op threads of torch (all the available cores if
+    threads is 0). The batches are never run in parallel, so one inter-op
+    thread is enough.
+    """
+    @staticmethod
+    def configure_threads(threads=0):
+        if threads <= 0:
+            threads = InferenceExecutor.available_cores()
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Can be set only once, before any parallel work has started
+            pass
+
+    # Returns the number of cores the process can run on.
+    @staticmethod
+    def available_cores():
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
+
+    def submit(self, kind, inputs):
+        future = Future()
+        self.requests.put((kind, inputs, future))
+        return future
+
+    # Embeds a list of texts, returns a float32 tensor (on CPU) with one row per text.
+    def encode_texts(self, texts):
+        return self.submit("text", list(texts)).result()
+
+    # Embeds a batch of images preprocessed by CLIPWrapper.preprocess_image(), returns a float32 tensor (on CPU).
+    def encode_images(self, tensors):
+        return self.submit("image", tensors).result()
+
+    # Collects the requests for one micro-batch: blocks until the first request comes,
+    # then waits at most max_wait seconds for more.
+    def collect(self):
+        requests = [self.requests.get()]
+        size = len(requests[0][1])
+        deadline = monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            size += len(request[1])
+        return requests
+
+    # Runs the model on the concatenated inputs of the requests and completes their futures.
+    def process(self, kind, requests):
+        try:
+            if kind == "text":
+                texts = [text for _, inputs, _ in requests for text in inputs]
+                embeddings = self.clip.encode_texts(texts)
+            else:
+                embeddings = self.clip.encode_images(torch.cat([inputs for _, inputs, _ in requests]))
+            embeddings = embeddings.float().cpu()
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for _, inputs, future in requests:
+            future.set_result(embeddings[start : start + len(inputs)])
+            start += len(inputs)
+
+    def run(self):
+        while True:
+            requests = self.collect()
+            for kind in ("text", "image"):
+                batch = [request for request in requests if request[0] == kind]
+                if batch:
+                    self.process(kind, batch)
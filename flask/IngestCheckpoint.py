@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import numpy as np
+from pathlib import Path
+
+
+"""
+Durable progress of building the library from scratch (see
+ImageManager.get_init_generators()), so an interrupted initialization
+resumes from its last completed chunk instead of starting over.
+
+When the initialization starts, the listing of the library (the paths and
+modified times of the images) is saved, and the images are then ingested in
+chunks. The embeddings and ids of each chunk are appended to raw files and
+synced to the disk, the rows of the chunk are committed to the database, and
+only then the manifest is atomically replaced with the new position in the
+listing. If the process is interrupted before the manifest was replaced, the
+chunk is ingested again: the files are truncated to the completed chunks and
+the committed rows with larger ids than the last completed one are deleted.
+
+The embeddings of the completed chunks are not kept in the memory, the index
+is built from the memory-mapped file when all the chunks are done.
+"""
+class IngestCheckpoint:
+    version = 1
+    manifest_filename = "manifest.json"
+    files_filename = "files.json"
+    embeddings_filename = "embeddings.f32"
+    ids_filename = "ids.i64"
+
+    def __init__(self, directory, model_name):
+        self.directory = Path(directory)
+        self.model_name = model_name
+        self.manifest = None
+
+    # Number of the images of the listing that were processed.
+    @property
+    def position(self):
+        return self.manifest["position"]
+
+    # Number of the images ingested (the images that disappeared before they were processed are skipped).
+    @property
+    def count(self):
+        return self.manifest["count"]
+
+    # Largest id of the images committed by the completed chunks.
+    @property
+    def last_id(self):
+        return self.manifest["last_id"]
+
+    # Reads the manifest, returns None if there is none (or it was written for another model).
+    def load_manifest(self):
+        try:
+            with open(self.directory / self.manifest_filename, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if manifest.get("version") != self.version or manifest.get("model") != self.model_name:
+            return None
+        return manifest
+
+    # Returns True if there is an interrupted initialization to resume.
+    def exists(self):
+        return self.load_manifest() is not None
+
+    """
+    Starts a new checkpoint (replacing the previous one) with the listing of
+    the library given as a list of pairs (path, mtime). The ids of the images
+    inserted by the initialization are larger than `last_id`.
+    """
+    def start(self, files, last_id=0):
+        self.delete()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.write_json(self.files_filename, files)
+        for filename in (self.embeddings_filename, self.ids_filename):
+            open(self.directory / filename, "wb").close()
+        self.manifest = {
+            "version": self.version,
+            "model": self.model_name,
+            "total": len(files),
+            "position": 0,
+            "count": 0,
+            "last_id": last_id,
+            "dim": None,
+        }
+        self.write_json(self.manifest_filename, self.manifest)
+
+    """
+    Opens the existing checkpoint and returns the listing of the library, or
+    None if there is no checkpoint. The data of the chunk that was not
+    completed are truncated.
+    """
+    def resume(self):
+        self.manifest = self.load_manifest()
+        if self.manifest is None:
+            return None
+        with open(self.directory / self.files_filename, "r") as f:
+            files = [tuple(file) for file in json.load(f)]
+        dim = self.manifest["dim"] or 0
+        os.truncate(self.directory / self.embeddings_filename, self.count * dim * 4)
+        os.truncate(self.directory / self.ids_filename, self.count * 8)
+        return files
+
+    # Appends the ids and the embeddings of a chunk and syncs them to the disk (the chunk is not completed yet).
+    def append(self, ids, embeddings):
+        arrays = (
+            (self.embeddings_filename, np.ascontiguousarray(embeddings, dtype=np.float32)),
+            (self.ids_filename, np.asarray(ids, dtype=np.int64)),
+        )
+        for filename, array in arrays:
+            with open(self.directory / filename, "ab") as f:
+                f.write(array.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self.manifest["dim"] = int(arrays[0][1].shape[1])
+
+    # Completes the appended chunk: the listing is processed up to `position`, the last inserted id is `last_id`.
+    def commit(self, position, count, last_id):
+        self.manifest.update(position=position, count=self.count + count, last_id=last_id)
+        self.write_json(self.manifest_filename, self.manifest)
+
+    # Returns the ids and the (memory-mapped) embeddings of the completed chunks.
+    def data(self):
+        dim = self.manifest["dim"] or 0
+        if self.count == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32)
+        ids = np.fromfile(self.directory / self.ids_filename, dtype=np.int64, count=self.count)
+        shape = (self.count, dim)
+        embeddings = np.memmap(self.directory / self.embeddings_filename, dtype=np.float32, mode="r", shape=shape)
+        return ids, embeddings
+
+    # Removes the checkpoint (when the initialization is finished, or a new one starts).
+    def delete(self):
+        self.manifest = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Writes the JSON file atomically (and durably).
+    def write_json(self, filename, value):
+        path = self.directory / filename
+        tmp = path.with_name(f".{filename}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(value, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
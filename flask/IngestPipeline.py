@@ -0,0 +1,185 @@
+import io
+import os
+import PIL.Image
+import numpy as np
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import available_memory
+
+
+"""
+Streaming pipeline for embedding the images of the library.
+
+A pool of worker threads reads, decodes and preprocesses the images into
+ready tensors (PIL and torch release the GIL for most of this work), while
+the CLIP model runs on the previous batches. Only `prefetch`
+batches are prepared ahead of the model, which bounds the memory usage when
+the decoding is faster than the inference.
+
+If an EmbeddingCache is given, the workers hash the content of each file and
+only the images whose embeddings are not cached are decoded and embedded.
+If a ThumbnailCache is given, the thumbnails of the decoded images are created
+as well (the images whose embeddings are cached are decoded only if they have
+no thumbnail yet).
+The batches are embedded by the encoder (an object with the encode_images()
+method, e.g. the InferenceExecutor), the CLIPWrapper itself by default.
+
+The batch size adapts to the memory pressure: if the inference runs out of
+memory, or less than `min_free_memory` bytes of memory are available before
+a batch is embedded, the batches are split into halves (see encode_tensors()).
+The limit grows back while enough memory is available, up to the largest
+size that did not run out of memory, and it is reset by each ingestion.
+"""
+class IngestPipeline:
+    def __init__(self, clip, workers=4, prefetch=2, cache=None, encoder=None, min_free_memory=0, thumbnails=None):
+        self.clip = clip
+        self.encoder = clip if encoder is None else encoder
+        self.workers = max(1, workers)
+        self.prefetch = max(1, prefetch)
+        self.cache = cache
+        self.thumbnails = thumbnails
+        self.min_free_memory = min_free_memory
+        # Maximal number of images embedded at once (None if not limited)
+        self.batch_limit = None
+        # The batch limit does not grow above it after the inference ran out of memory (None if it did not)
+        self.max_batch_limit = None
+
+    """
+    Reads the image given by path and returns a tuple (hash, embedding,
+    tensor). If the embedding is cached, the image is not decoded and the
+    tensor is None, otherwise the embedding is None and the tensor is the
+    decoded and preprocessed image.
+    """
+    def load(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+
+        hash = None
+        embedding = None
+        if self.cache is not None:
+            hash = self.cache.hash(data)
+            embedding = self.cache.get(hash)
+        thumbnail = self.thumbnails is not None and not self.thumbnails.exists(path, mtime_ns)
+        if embedding is not None and not thumbnail:
+            return hash, embedding, None
+
+        with PIL.Image.open(io.BytesIO(data)) as img:
+            # Let the JPEG decoder downscale large images right away
+            # (the result is still at least as large as the model input and the thumbnail)
+            size = self.clip.input_resolution
+            if thumbnail:
+                size = max(size, self.thumbnails.size)
+            img.draft("RGB", (size, size))
+            if thumbnail:
+                try:
+                    self.thumbnails.create(img, path, mtime_ns)
+                except OSError as e:
+                    # The thumbnail is created again when it is requested
+                    print(f"IngestPipeline: cannot create the thumbnail of {path}: {e}")
+            if embedding is not None:
+                return hash, embedding, None
+            return hash, None, self.clip.preprocess_image(img)
+
+    # Embeds the loaded images that were not found in the cache (and caches
+    # them), and returns the embeddings of all of them as a float32 tensor.
+    def encode(self, loaded):
+        embeddings = [embedding for _, embedding, _ in loaded]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = self.encode_tensors(torch.stack([loaded[i][2] for i in missing]))
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+            if self.cache is not None:
+                self.cache.put([loaded[i][0] for i in missing], encoded)
+        return torch.from_numpy(np.stack(embeddings))
+
+    # Returns True if the exception means that the inference ran out of memory.
+    @staticmethod
+    def out_of_memory(e):
+        if isinstance(e, MemoryError):
+            return True
+        message = str(e).lower()
+        return isinstance(e, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+    # Returns True if less than min_free_memory bytes of memory are available.
+    def low_memory(self):
+        if self.min_free_memory <= 0:
+            return False
+        available = available_memory()
+        return available is not None and available < self.min_free_memory
+
+    # Halves the batch limit (the batches of `size` images did not fit).
+    def reduce_batch_limit(self, size, reason):
+        self.batch_limit = max(1, size // 2)
+        print(f"IngestPipeline: {reason}, embedding at most {self.batch_limit} images at once")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    # Doubles the batch limit after a sub-batch was embedded with enough memory available.
+    def grow_batch_limit(self):
+        if self.batch_limit is None or self.low_memory():
+            return
+        limit = self.batch_limit * 2
+        if self.max_batch_limit is not None:
+            limit = min(limit, self.max_batch_limit)
+        self.batch_limit = limit
+
+    """
+    Embeds the preprocessed images in sub-batches of at most batch_limit
+    images, returns the float32 embeddings. The available memory is checked
+    before each sub-batch, and the limit is halved at most once per sub-batch
+    when it runs low. If the inference runs out of memory, the limit is
+    halved and the sub-batch is embedded again; it fails only if even a
+    single image does not fit.
+    """
+    def encode_tensors(self, tensors):
+        results = []
+        start = 0
+        while start < len(tensors):
+            size = len(tensors) - start
+            if self.batch_limit is not None:
+                size = min(size, self.batch_limit)
+            if size > 1 and self.low_memory():
+                self.reduce_batch_limit(size, "low memory")
+                size = self.batch_limit
+            try:
+                encoded = self.encoder.encode_images(tensors[start : start + size])
+            except Exception as e:
+                if size == 1 or not self.out_of_memory(e):
+                    raise
+                self.reduce_batch_limit(size, "out of memory")
+                self.max_batch_limit = self.batch_limit
+                continue
+            results.append(encoded.float().cpu().numpy())
+            start += size
+            self.grow_batch_limit()
+        return np.concatenate(results)
+
+    """
+    Embeds the images given by the batches of paths. Yields the pairs (batch,
+    embeddings) in the same order as the batches were given, as soon as each
+    of the batches is processed. If the batches contain other items than
+    paths, `path` is the function returning the path of an item.
+    """
+    def embed(self, batches, path=None):
+        if path is None:
+            path = lambda item: item
+        batches = iter(batches)
+        pending = deque()
+        # The memory pressure of a previous ingestion does not limit this one
+        self.batch_limit = None
+        self.max_batch_limit = None
+        with ThreadPoolExecutor(self.workers) as executor:
+            def submit():
+                batch = next(batches, None)
+                if batch is not None:
+                    pending.append((batch, [executor.submit(self.load, path(item)) for item in batch]))
+
+            for _ in range(self.prefetch):
+                submit()
+            while pending:
+                batch, futures = pending.popleft()
+                submit()
+                yield batch, self.encode([future.result() for future in futures])
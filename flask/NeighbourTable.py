@@ -0,0 +1,218 @@
+import json
+import os
+import secrets
+import numpy as np
+from itertools import chain
+from pathlib import Path
+
+
+"""
+Precomputed table of the `size` nearest neighbours of each image of the
+library, so browsing the library (searching by the id of an image) is only a
+lookup of one row instead of a search of the whole index.
+
+The table is computed exactly (by the blocked search of the EmbeddingIndex)
+for blocks of images whose size is given by a memory budget, and updated
+incrementally when images are added or modified: the new images get their
+own rows, and they are merged into the rows of the other images. Rows of the
+removed images are dropped by the next update, and the removed neighbours are
+skipped when the table is read.
+
+On the disk, the table is stored next to the index files as raw arrays of the
+row ids, neighbour ids and scores, described by a small JSON header. The
+arrays are memory-mapped read-only.
+"""
+class NeighbourTable:
+    header_filename = "knn.json"
+
+    def __init__(self, directory, size=100):
+        self.directory = Path(directory)
+        self.size = size
+        self.row_ids = np.empty(0, dtype=np.int64)
+        self.neighbours = np.empty((0, size), dtype=np.int64)
+        self.scores = np.empty((0, size), dtype=np.float32)
+        self._rows = None
+
+    # Returns the dictionary mapping the image ids to the rows of the table.
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = dict(zip(self.row_ids.tolist(), range(len(self.row_ids))))
+        return self._rows
+
+    def __contains__(self, id):
+        return id in self.rows
+
+    # Returns the ids of the nearest neighbours of the image (sorted by decreasing similarity), or None.
+    def get(self, id):
+        row = self.rows.get(id)
+        if row is None:
+            return None
+        neighbours = self.neighbours[row]
+        return neighbours[neighbours >= 0]
+
+    # Opens the table saved in the directory, returns None if there is none (or it has another size).
+    @classmethod
+    def load(cls, directory, size=100):
+        directory = Path(directory)
+        try:
+            with open(directory / cls.header_filename, "r") as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            return None
+        if header["size"] != size:
+            return None
+
+        table = cls(directory, size)
+        count = header["count"]
+        if count > 0:
+            table.row_ids = np.memmap(directory / header["rows"], dtype=np.int64, mode="r", shape=(count,))
+            shape = (count, size)
+            table.neighbours = np.memmap(directory / header["neighbours"], dtype=np.int64, mode="r", shape=shape)
+            table.scores = np.memmap(directory / header["scores"], dtype=np.float32, mode="r", shape=shape)
+        return table
+
+    # Removes the table from the directory.
+    @classmethod
+    def delete(cls, directory):
+        directory = Path(directory)
+        (directory / cls.header_filename).unlink(missing_ok=True)
+        for file in directory.glob("knn-*"):
+            file.unlink()
+
+    """
+    Writes the blocks (row ids, neighbour ids, scores) to new files, replaces
+    the header and removes the old files. The blocks are written as they come,
+    so they do not have to be in the memory at once; the generator yields after
+    each of them.
+    """
+    def save(self, blocks):
+        token = secrets.token_hex(8)
+        header = {
+            "size": self.size,
+            "count": 0,
+            "rows": f"knn-rows-{token}.i64",
+            "neighbours": f"knn-neighbours-{token}.i64",
+            "scores": f"knn-scores-{token}.f32",
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = [open(self.directory / header[key], "wb") for key in ("rows", "neighbours", "scores")]
+        try:
+            for block in blocks:
+                for f, array, dtype in zip(files, block, (np.int64, np.int64, np.float32)):
+                    np.ascontiguousarray(array, dtype=dtype).tofile(f)
+                header["count"] += len(block[0])
+                yield
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            for f in files:
+                f.close()
+
+        tmp = self.directory / (self.header_filename + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(header, f, indent="\t")
+        os.replace(tmp, self.directory / self.header_filename)
+        for file in self.directory.glob("knn-*"):
+            if file.name not in header.values():
+                file.unlink()
+
+        table = self.load(self.directory, self.size)
+        self.row_ids, self.neighbours, self.scores = table.row_ids, table.neighbours, table.scores
+        self._rows = None
+
+    # Returns the number of queries processed at once by a search of the index within the memory budget.
+    def query_block_size(self, index, memory_mb):
+        n = max(1, index.data.shape[0])
+        block_size = min(index.block_size, n)
+        # Scores and indices of one block of the index, and the best candidates of all the blocks, for each query
+        candidates = block_size + -(-n // block_size) * min(self.size, n)
+        return max(1, memory_mb * 1024 * 1024 // (candidates * 12))
+
+    # Returns the number of rows merged at once with `count` new neighbours by update() within the memory budget.
+    def merge_block_size(self, count, memory_mb):
+        # Scores, ids and the partition of the candidates, and the merged row, for each row
+        return max(1, memory_mb * 1024 * 1024 // ((self.size + count) * 20 + self.size * 12))
+
+    """
+    Yields the blocks (row ids, neighbour ids, scores) of the nearest neighbours
+    of the images in the given slots of the index. The neighbours are padded by
+    the id -1 if the index is smaller than the table.
+    """
+    def compute(self, index, slots, memory_mb):
+        k = min(self.size, len(index))
+        step = self.query_block_size(index, memory_mb)
+        for start in range(0, len(slots), step):
+            block = np.asarray(slots[start : start + step])
+            queries = np.asarray(index.data[block], dtype=np.float32)
+            scores, found = index._search_blocks(index.data, k, index.block_size, lambda b: queries @ b.T)
+            neighbours = np.full((len(block), self.size), -1, dtype=np.int64)
+            padded_scores = np.full((len(block), self.size), -np.inf, dtype=np.float32)
+            neighbours[:, :k] = np.asarray(index.ids)[found]
+            padded_scores[:, :k] = scores
+            yield np.asarray(index.ids)[block], neighbours, padded_scores
+
+    # Computes the table for all the images of the index. Yields after each block (for the progress bar).
+    def build(self, index, memory_mb=256):
+        live = np.flatnonzero(np.asarray(index.ids) >= 0)
+        yield from self.save(self.compute(index, live, memory_mb))
+
+    # Returns the number of steps (yields) of build().
+    def build_steps(self, index, memory_mb=256):
+        live = np.count_nonzero(np.asarray(index.ids) >= 0)
+        return -(-live // self.query_block_size(index, memory_mb))
+
+    # Merges the new neighbours (the same ids for all the rows) with their scores into the rows.
+    def merge(self, neighbours, scores, new_ids, new_scores):
+        candidates = np.concatenate([scores, new_scores], axis=1)
+        candidate_ids = np.concatenate([neighbours, np.broadcast_to(new_ids, new_scores.shape)], axis=1)
+        top = np.argpartition(-candidates, self.size - 1, axis=1)[:, : self.size]
+        order = np.argsort(-np.take_along_axis(candidates, top, axis=1), axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        return np.take_along_axis(candidate_ids, top, axis=1), np.take_along_axis(candidates, top, axis=1)
+
+    """
+    Updates the table after the images with the given ids were added to the
+    index or modified. Their rows are computed again, and they replace the
+    neighbours of the other images that are less similar to them. The rows of
+    the images removed from the index are dropped.
+
+    The rows are streamed from the old files to the new ones in blocks, and
+    the new images are merged into them in chunks of at most index.block_size
+    images, so the memory usage is bounded by the budget.
+    """
+    def update(self, index, ids, memory_mb=256):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[[id in index for id in ids.tolist()]]
+        chunk = max(1, min(len(ids), index.block_size))
+        step = self.merge_block_size(chunk, memory_mb)
+
+        def merged():
+            for start in range(0, len(self.row_ids), step):
+                row_ids = np.asarray(self.row_ids[start : start + step])
+                keep = np.array([id in index for id in row_ids.tolist()], dtype=bool) & ~np.isin(row_ids, ids)
+                if not keep.any():
+                    continue
+                row_ids = row_ids[keep]
+                neighbours = np.asarray(self.neighbours[start : start + step])[keep]
+                scores = np.asarray(self.scores[start : start + step])[keep]
+
+                # The old scores of the modified images are not valid anymore
+                stale = np.isin(neighbours, ids)
+                neighbours[stale] = -1
+                scores[stale] = -np.inf
+
+                if len(ids) > 0:
+                    vectors = np.asarray(index.data[[index.slots[id] for id in row_ids.tolist()]], dtype=np.float32)
+                    for i in range(0, len(ids), chunk):
+                        new_ids = ids[i : i + chunk]
+                        new_slots = [index.slots[id] for id in new_ids.tolist()]
+                        new_vectors = np.asarray(index.data[new_slots], dtype=np.float32)
+                        neighbours, scores = self.merge(neighbours, scores, new_ids, vectors @ new_vectors.T)
+                    neighbours[np.isneginf(scores)] = -1
+                yield row_ids, neighbours, scores
+
+        new_slots = np.array([index.slots[id] for id in ids.tolist()], dtype=np.int64)
+        for _ in self.save(chain(merged(), self.compute(index, new_slots, memory_mb))):
+            pass
@@ -0,0 +1,78 @@
+import inspect
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+"""
+Image and text encoders of a CLIP model exported to ONNX and run by ONNX
+Runtime on CPU, with all the graph optimizations enabled. The exported
+graphs are saved to `image.onnx` and `text.onnx` in the given directory, so
+the export runs only once. Requires the optional `onnxruntime` package.
+
+The encoders have the same interface as the CLIP model (encode_image() and
+encode_text()), see CLIPWrapper.
+"""
+class OnnxEncoder:
+    name = "onnx"
+    filenames = {"image": "image.onnx", "text": "text.onnx"}
+    opset_version = 14
+
+    def __init__(self, image_session, text_session):
+        self.image_session = image_session
+        self.text_session = text_session
+
+    @staticmethod
+    def available():
+        return onnxruntime is not None
+
+    # Exports the modules traced on the example inputs to the directory (with a dynamic batch size).
+    @classmethod
+    def export(cls, modules, examples, directory):
+        kwargs = {}
+        # The newer versions of torch export by the dynamo exporter by default
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        for kind in ("image", "text"):
+            with torch.no_grad():
+                torch.onnx.export(
+                    modules[kind].eval(),
+                    (examples[kind],),
+                    str(directory / cls.filenames[kind]),
+                    input_names=["input"],
+                    output_names=["embedding"],
+                    dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+                    opset_version=cls.opset_version,
+                    **kwargs,
+                )
+
+    # Opens the exported graphs. The sessions use the given number of threads (0 for all the cores).
+    @classmethod
+    def load(cls, directory, threads=0):
+        if onnxruntime is None:
+            raise ImportError("The ONNX backend requires the onnxruntime package")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = max(0, threads)
+        options.inter_op_num_threads = 1
+        sessions = [
+            onnxruntime.InferenceSession(
+                str(directory / cls.filenames[kind]), options, providers=["CPUExecutionProvider"]
+            )
+            for kind in ("image", "text")
+        ]
+        return cls(*sessions)
+
+    @staticmethod
+    def run(session, inputs):
+        return torch.from_numpy(session.run(None, {"input": inputs.cpu().numpy()})[0])
+
+    def encode_image(self, tensors):
+        return self.run(self.image_session, tensors)
+
+    def encode_text(self, tokens):
+        return self.run(self.text_session, tokens)
@@ -0,0 +1,120 @@
+import numpy as np
+import os
+
+
+"""
+Compact table of the image paths and modified times, aligned with the slots of
+an EmbeddingIndex, so the results of a search can be returned without querying
+the database.
+
+The paths are stored as one UTF-8 blob with an array of offsets (the path of
+slot i is blob[offsets[i]:offsets[i+1]]), and the modified times as an array
+of float64 timestamps. On the disk, these are three raw files next to the files
+of the index; they are memory-mapped read-only, the same as the embeddings.
+Removed slots keep their paths, they are skipped by the index itself.
+"""
+class PathTable:
+    chunk_size = 65536
+
+    def __init__(self, paths=(), mtimes=None):
+        encoded = [path.encode("utf-8") for path in paths]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        if mtimes is None:
+            mtimes = np.zeros(len(encoded))
+        self.mtimes = np.array(mtimes, dtype=np.float64).reshape(-1)
+        if len(self.mtimes) != len(encoded):
+            raise ValueError("The number of paths and modified times does not match")
+        self.directory = None
+        self.files = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Returns the path stored in the given slot.
+    def path(self, slot):
+        return self.blob[self.offsets[slot] : self.offsets[slot + 1]].tobytes().decode("utf-8")
+
+    # Returns the modified time (a POSIX timestamp) stored in the given slot.
+    def mtime(self, slot):
+        return float(self.mtimes[slot])
+
+    def _path(self, name):
+        return self.directory / self.files[name]
+
+    """
+    Writes the given slots (all if None) of the table to new files (with the
+    given token in their names) in the given directory and memory-maps them.
+    Returns the dictionary of the filenames, to be stored in the index header.
+    """
+    def save(self, directory, token, slots=None):
+        if slots is None:
+            slots = np.arange(len(self))
+        files = {
+            "paths": f"paths-{token}.bin",
+            "offsets": f"offsets-{token}.i64",
+            "mtimes": f"mtimes-{token}.f64",
+        }
+        with open(directory / files["paths"], "wb") as fp, \
+             open(directory / files["offsets"], "wb") as fo, \
+             open(directory / files["mtimes"], "wb") as fm:
+            offset = 0
+            np.zeros(1, dtype=np.int64).tofile(fo)
+            for start in range(0, len(slots), self.chunk_size):
+                chunk = np.asarray(slots[start : start + self.chunk_size])
+                for slot in chunk.tolist():
+                    fp.write(self.blob[self.offsets[slot] : self.offsets[slot + 1]].tobytes())
+                lengths = self.offsets[chunk + 1] - self.offsets[chunk]
+                (offset + np.cumsum(lengths)).astype(np.int64).tofile(fo)
+                offset += int(lengths.sum())
+                np.ascontiguousarray(self.mtimes[chunk]).tofile(fm)
+            for f in (fp, fo, fm):
+                f.flush()
+                os.fsync(f.fileno())
+        PathTable.load(directory, files, len(slots), into=self)
+        return files
+
+    """
+    Memory-maps the table of `count` slots from the files (the dictionary
+    returned by save()) in the given directory. The files may be longer than
+    `count` slots, if the application was interrupted while appending to them.
+    """
+    @classmethod
+    def load(cls, directory, files, count, into=None):
+        table = cls.__new__(cls) if into is None else into
+        table.directory = directory
+        table.files = files
+        table.offsets = np.memmap(table._path("offsets"), dtype=np.int64, mode="r", shape=(count + 1,))
+        size = int(table.offsets[-1])
+        if size > 0:
+            table.blob = np.memmap(table._path("paths"), dtype=np.uint8, mode="r", shape=(size,))
+        else:
+            table.blob = np.empty(0, dtype=np.uint8)
+        if count > 0:
+            table.mtimes = np.memmap(table._path("mtimes"), dtype=np.float64, mode="r", shape=(count,))
+        else:
+            table.mtimes = np.empty(0, dtype=np.float64)
+        return table
+
+    # Returns the minimal sizes of the files of a table with `count` slots (without the blob).
+    @staticmethod
+    def file_sizes(files, count):
+        return {files["offsets"]: 8 * (count + 1), files["mtimes"]: 8 * count}
+
+    """
+    Appends the paths and modified times of new slots to the files. The table
+    itself does not change until it is loaded again with the new count.
+    """
+    def append(self, paths, mtimes):
+        new = PathTable(paths, mtimes)
+        count, size = len(self), int(self.offsets[-1])
+        for name, array, position in (
+            ("paths", new.blob, size),
+            ("offsets", new.offsets[1:] + size, 8 * (count + 1)),
+            ("mtimes", new.mtimes, 8 * count),
+        ):
+            with open(self._path(name), "r+b") as f:
+                f.truncate(position)
+                f.seek(position)
+                array.tofile(f)
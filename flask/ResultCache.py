@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from settings import settings
+import numpy as np
+import sys
+import threading
+
+"""
+Caches the ranked lists of image ids returned by the queries, keyed by
+(query kind, query key, model name), so browsing the next pages of the
+results is only a slice of the cached list. The queries fetch a few pages
+ahead of the requested one (RESULT_CACHE_PREFETCH_PAGES); a longer list is
+fetched only when the user pages beyond the cached results.
+
+The least recently used lists are evicted when the total size of the cached
+lists exceeds RESULT_CACHE_SIZE_MB. The cache must be cleared whenever the
+library changes.
+"""
+class ResultCache:
+    # Approximate memory used by an entry besides the array of ids
+    entry_overhead = 256
+
+    def __init__(self):
+        self.max_bytes = settings.RESULT_CACHE_SIZE_MB * 1024 * 1024
+        self.prefetch_pages = settings.RESULT_CACHE_PREFETCH_PAGES
+        self.cache = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_size(key, ids):
+        return ids.nbytes + sys.getsizeof(key) + ResultCache.entry_overhead
+
+    """
+    Returns the cached ids for the key if there are at least k of them (or if
+    the list contains all the results of the query), None otherwise.
+    """
+    def get(self, key, k):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None or (len(entry[0]) < k and not entry[1]):
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # Stores the ranked ids of the query. Complete is True if the list contains all the results.
+    def put(self, key, ids, complete=False):
+        ids = np.array(ids, dtype=np.int64)
+        size = self.entry_size(key, ids)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.cache:
+                self.size -= self.entry_size(key, self.cache.pop(key)[0])
+            self.cache[key] = (ids, complete)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_ids, _) = self.cache.popitem(last=False)
+                self.size -= self.entry_size(old_key, old_ids)
+
+    """
+    Returns the ids of the images on the given page of the results. The ids
+    are taken from the cache, or the query is run by the search function and
+    its results are cached. The search function is called with the number of
+    results to fetch, and returns the pair (ids, complete).
+    """
+    def page(self, key, page, page_size, search):
+        k = page_size * page
+        ids = self.get(key, k)
+        if ids is None:
+            ids, complete = search(page_size * (page + self.prefetch_pages))
+            ids = np.asarray(ids, dtype=np.int64)
+            self.put(key, ids, complete)
+        return ids[k - page_size : k]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.size = 0
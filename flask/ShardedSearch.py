@@ -0,0 +1,176 @@
+import os
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import Future
+from itertools import count
+from EmbeddingIndex import EmbeddingIndex
+
+
+# Environment variables limiting the threads of the BLAS libraries used by numpy
+BLAS_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS")
+# Serializes the changes of the environment inherited by the started workers
+_environment_lock = threading.Lock()
+
+
+# Main loop of a worker process searching one shard of the index.
+def _shard_worker(conn, directory, model_name, shard, shards, options):
+    part = None
+
+    def load():
+        # The shard is only read, the codes saved with the index are used as they are
+        # (the application process converts them, see EmbeddingIndex.load())
+        index = EmbeddingIndex.load(directory, model_name, read_only=True, **options)
+        count = index.data.shape[0]
+        return index.shard(count * shard // shards, count * (shard + 1) // shards)
+
+    try:
+        while True:
+            request_id, *message = conn.recv()
+            try:
+                if message[0] == "search":
+                    conn.send((request_id, part.search(message[1], message[2])))
+                elif message[0] == "load":
+                    part = load()
+                    conn.send((request_id, len(part)))
+                elif message[0] == "stop":
+                    break
+            except Exception as e:
+                conn.send((request_id, e))
+    except (EOFError, KeyboardInterrupt):
+        # The application was stopped
+        pass
+
+
+"""
+Exact search of the EmbeddingIndex split into `shards` contiguous ranges of
+slots, each of them searched by its own worker process.
+
+The workers memory-map the same index files (the pages are shared through the
+OS page cache), so the shards cost no extra memory. A query is sent to all the
+workers, each of them returns its k best results, and the lists are merged.
+The matrix products and the selection of the best results thus run on all the
+cores, without being limited by the GIL of the application process. The BLAS
+libraries of each worker use at most `threads` threads, so the workers do not
+oversubscribe the cores.
+
+The messages are tagged by request ids, and the responses of each worker are
+received by its own thread and matched to the waiting requests, so concurrent
+queries are pipelined through the workers instead of waiting for each other.
+The workers only read the index files.
+
+The workers are started with the "spawn" method, so they do not inherit the
+threads (and the CLIP model) of the application. After the index is changed
+on the disk, reload() must be called.
+"""
+class ShardedSearch:
+    def __init__(self, directory, model_name, shards, options=None, threads=1):
+        self.shards = shards
+        # Serializes the sending of the messages (the pipes are not thread-safe)
+        self.lock = threading.Lock()
+        self.request_ids = count()
+        # Futures of the responses of the workers for each pending request id
+        self.pending = {}
+        # False for the workers that were stopped (or crashed)
+        self.alive = [True] * shards
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        with _environment_lock:
+            environment = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+            os.environ.update({name: str(threads) for name in BLAS_THREAD_VARIABLES})
+            try:
+                for shard in range(shards):
+                    conn, child_conn = context.Pipe()
+                    process = context.Process(
+                        target=_shard_worker,
+                        args=(child_conn, str(directory), model_name, shard, shards, options or {}),
+                        daemon=True,
+                    )
+                    process.start()
+                    self.connections.append(conn)
+                    self.processes.append(process)
+            finally:
+                for name, value in environment.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+        for shard, conn in enumerate(self.connections):
+            threading.Thread(target=self._receive, args=(shard, conn), daemon=True).start()
+        self.reload()
+
+    # Receives the responses of one worker and resolves the futures of the requests.
+    def _receive(self, shard, conn):
+        while True:
+            try:
+                request_id, response = conn.recv()
+            except (EOFError, OSError):
+                break
+            self.pending[request_id][shard].set_result(response)
+        # The worker was stopped, fail the requests still waiting for it
+        with self.lock:
+            self.alive[shard] = False
+            for futures in self.pending.values():
+                if not futures[shard].done():
+                    futures[shard].set_result(EOFError(f"Shard worker {shard} stopped"))
+
+    # Sends the message to all the workers and returns their responses.
+    def _broadcast(self, message):
+        futures = [Future() for _ in self.connections]
+        with self.lock:
+            if not all(self.alive):
+                raise EOFError("The shard workers were stopped")
+            request_id = next(self.request_ids)
+            self.pending[request_id] = futures
+            try:
+                for conn in self.connections:
+                    conn.send((request_id, *message))
+            except Exception:
+                del self.pending[request_id]
+                raise
+        try:
+            responses = [future.result() for future in futures]
+        finally:
+            del self.pending[request_id]
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        return responses
+
+    # Makes the workers load the current version of the index from the disk.
+    def reload(self):
+        self.count = sum(self._broadcast(("load",)))
+
+    def __len__(self):
+        return self.count
+
+    """
+    Returns the k most similar images for each of the query vectors, the same
+    as EmbeddingIndex.search().
+    """
+    def search(self, queries, k=1):
+        queries = EmbeddingIndex.normalize(queries)
+        results = self._broadcast(("search", queries, k))
+        scores = np.concatenate([scores for scores, _ in results], axis=1)
+        ids = np.concatenate([ids for _, ids in results], axis=1)
+        k = min(k, scores.shape[1])
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, top, axis=1)
+            ids = np.take_along_axis(ids, top, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    # Stops the workers.
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.send((next(self.request_ids), "stop"))
+                except (BrokenPipeError, OSError):
+                    pass
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
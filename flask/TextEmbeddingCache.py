@@ -0,0 +1,114 @@
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from time import monotonic
+
+"""
+Bounded LRU cache of text query embeddings keyed by pairs (normalized text,
+model name), so the popular queries do not run the text encoder again.
+
+The text is normalized the same way as the CLIP tokenizer does it (collapsed
+whitespace, lower case), so texts differing only in these get the same
+embedding. If a path is given, the cache is loaded from it on startup and
+saved to it at most once per `save_interval` seconds (and by save(), e.g.
+before restarting the application), so the warm queries survive the restarts.
+"""
+class TextEmbeddingCache:
+    def __init__(self, model_name, max_size=1024, path=None, save_interval=60):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.path = None if path is None else Path(path)
+        self.save_interval = save_interval
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.last_save = monotonic()
+        if self.path is not None:
+            self.load()
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split()).lower()
+
+    def key(self, text):
+        return (self.normalize(text), self.model_name)
+
+    # Returns the cached embedding of the text, or None.
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            embedding = self.cache.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, text, embedding):
+        with self.lock:
+            self.cache[self.key(text)] = np.asarray(embedding, dtype=np.float32)
+            self.cache.move_to_end(self.key(text))
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            self.dirty = True
+        if self.path is not None and monotonic() - self.last_save > self.save_interval:
+            self.save()
+
+    """
+    Returns the embedding of the text from the cache. On a miss, the embedding
+    is computed by the given function (called with the text), converted to a
+    numpy array and cached.
+    """
+    def get_or_compute(self, text, compute):
+        embedding = self.get(text)
+        if embedding is None:
+            embedding = np.asarray(compute(text), dtype=np.float32)
+            self.put(text, embedding)
+        return embedding
+
+    # Returns the number of hits and misses since the application started.
+    def stats(self):
+        return {"size": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+    # Loads the embeddings of the current model saved by save().
+    def load(self):
+        try:
+            with np.load(self.path) as f:
+                if str(f["model"]) != self.model_name:
+                    return
+                texts, vectors = f["texts"].tolist(), f["vectors"]
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return
+        with self.lock:
+            for text, vector in zip(texts[-self.max_size :], vectors[-self.max_size :]):
+                self.cache[(text, self.model_name)] = vector.reshape(1, -1)
+
+    # Saves the cached embeddings (from the least to the most recently used) to the disk, if they changed.
+    def save(self):
+        if self.path is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                texts = [text for text, _ in self.cache]
+                vectors = list(self.cache.values())
+                self.dirty = False
+                self.last_save = monotonic()
+            if len(vectors) > 0:
+                vectors = np.stack([np.reshape(v, -1) for v in vectors])
+            else:
+                vectors = np.empty((0, 0), dtype=np.float32)
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                np.savez(f, model=self.model_name, texts=np.array(texts, dtype=str), vectors=vectors)
+            os.replace(tmp, self.path)
+        print(f"Text embedding cache saved: {self.stats()}")
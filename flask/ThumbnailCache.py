@@ -0,0 +1,88 @@
+import hashlib
+import os
+import tempfile
+import PIL.Image
+import PIL.ImageOps
+from PIL import features
+
+
+"""
+On-disk cache of the thumbnails of the library images, served to the result
+pages instead of the full-resolution originals.
+
+The thumbnails are WebP images (JPEG if Pillow was built without WebP) whose
+longer side is at most `size` pixels. They are created by the ingestion from
+the image it already decoded for CLIP (see IngestPipeline.load()), or lazily
+when a missing thumbnail is requested. A thumbnail is identified by the hash
+of the absolute path and the modified time of the image (and the size and
+quality), so a modified image gets a new one. The files are spread into
+subdirectories by the first bytes of the hash, two levels deep, so no
+directory grows too large. Files are written atomically, so concurrent
+processes never read a partial thumbnail.
+"""
+class ThumbnailCache:
+    def __init__(self, directory, size=320, quality=80):
+        self.directory = directory
+        self.size = size
+        self.quality = quality
+        if features.check("webp"):
+            self.format, self.extension, self.mimetype = "WEBP", "webp", "image/webp"
+        else:
+            self.format, self.extension, self.mimetype = "JPEG", "jpg", "image/jpeg"
+
+    # Returns the key of the thumbnail of the image given by path and modified time (in nanoseconds).
+    def key(self, path, mtime_ns):
+        value = f"{os.path.abspath(path)}\0{mtime_ns}\0{self.size}\0{self.quality}\0{self.format}"
+        return hashlib.sha1(value.encode("utf-8", "surrogateescape")).hexdigest()
+
+    # Returns the path of the file of the thumbnail with the given key.
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key[2:4], f"{key}.{self.extension}")
+
+    def exists(self, path, mtime_ns):
+        return os.path.isfile(self.filename(self.key(path, mtime_ns)))
+
+    """
+    Creates the thumbnail of the image given by path and modified time from
+    the opened PIL image (the image itself is not changed). Returns the path
+    of the thumbnail file.
+    """
+    def create(self, img, path, mtime_ns):
+        thumbnail = PIL.ImageOps.exif_transpose(img)
+        if thumbnail.mode not in ("RGB", "RGBA") or (thumbnail.mode == "RGBA" and self.format == "JPEG"):
+            alpha = self.format == "WEBP" and ("A" in thumbnail.getbands() or "transparency" in thumbnail.info)
+            thumbnail = thumbnail.convert("RGBA" if alpha else "RGB")
+        thumbnail.thumbnail((self.size, self.size), PIL.Image.BICUBIC)
+
+        filename = self.filename(self.key(path, mtime_ns))
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        # Each writer (thread or process) has its own temporary file
+        with tempfile.NamedTemporaryFile(dir=directory, prefix=".", suffix=".tmp", delete=False) as f:
+            tmp = f.name
+            try:
+                thumbnail.save(f, self.format, quality=self.quality)
+            except BaseException:
+                f.close()
+                os.remove(tmp)
+                raise
+        try:
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return filename
+
+    """
+    Returns the path of the thumbnail file of the image given by path and
+    modified time, creating it if it is missing. Raises OSError if the image
+    cannot be read.
+    """
+    def get_or_create(self, path, mtime_ns):
+        filename = self.filename(self.key(path, mtime_ns))
+        if os.path.isfile(filename):
+            return filename
+        with PIL.Image.open(path) as img:
+            # Let the JPEG decoder downscale large images right away
+            img.draft("RGB", (self.size, self.size))
+            return self.create(img, path, mtime_ns)
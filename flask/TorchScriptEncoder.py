@@ -0,0 +1,45 @@
+import torch
+
+
+"""
+Image and text encoders of a CLIP model traced to TorchScript, frozen and
+optimized for inference on CPU (the operators are fused and the weights are
+folded into the graph). The traced modules are saved to `image.pt` and
+`text.pt` in the given directory, so the tracing runs only once.
+
+The encoders have the same interface as the CLIP model (encode_image() and
+encode_text()), see CLIPWrapper.
+"""
+class TorchScriptEncoder:
+    name = "torchscript"
+    filenames = {"image": "image.pt", "text": "text.pt"}
+
+    def __init__(self, image_module, text_module):
+        self.image_module = image_module
+        self.text_module = text_module
+
+    # Traces the modules on the example inputs and saves them to the directory.
+    @classmethod
+    def export(cls, modules, examples, directory):
+        for kind in ("image", "text"):
+            with torch.no_grad():
+                module = torch.jit.trace(modules[kind].eval(), examples[kind], check_trace=False)
+            module = torch.jit.freeze(module)
+            torch.jit.save(module, str(directory / cls.filenames[kind]))
+
+    # Loads the modules saved by export(). The number of threads is set for the whole process by the InferenceExecutor.
+    @classmethod
+    def load(cls, directory, threads=0):
+        modules = []
+        for kind in ("image", "text"):
+            module = torch.jit.load(str(directory / cls.filenames[kind]), map_location="cpu")
+            modules.append(torch.jit.optimize_for_inference(module))
+        return cls(*modules)
+
+    def encode_image(self, tensors):
+        with torch.no_grad():
+            return self.image_module(tensors)
+
+    def encode_text(self, tokens):
+        with torch.no_grad():
+            return self.text_module(tokens)
@@ -4,12 +4,15 @@
 class FlaskExitException(Exception):
     pass
 
-def run_app(conn=None, log_file=None):
+def run_app(conn=None, log_file=None, sock=None):
     import werkzeug.exceptions
     from flask import Flask
     from models import db
     from views import Views
+    from ImageManager import ImageManager
     from settings import settings
+    import os
+    import signal
     import sys
     import waitress
 
@@ -20,7 +23,10 @@ def run_app(conn=None, log_file=None):
 
     print(f"Using model: {settings.MODEL_NAME}")
     app = Flask(__name__)
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + settings.MODEL_NAME.replace("/", "_") + '.db'
+    # The images of each embedding name (the model tagged by its precision mode) are in their own database,
+    # so the library of one precision mode is refreshed or reset without touching the others
+    _, _, embedding_name = ImageManager.expected_embedding(settings.MODEL_NAME, settings.PREFER_CUDA)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + embedding_name.replace("/", "_") + '.db'
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = settings.SQLALCHEMY_TRACK_MODIFICATIONS
     db.init_app(app)
 
@@ -76,6 +82,10 @@ def run_app(conn=None, log_file=None):
     def get_file(filename):
         return views.get_db_image(filename)
 
+    @app.route("/thumbnails/<path:filename>")
+    def get_thumbnail(filename):
+        return views.get_thumbnail(filename)
+
 
     @app.route("/session_id/")
     def session_id():
@@ -121,11 +131,22 @@ def run_app(conn=None, log_file=None):
 
     ###############################
 
-    if settings.DEBUG:
-        app.run(debug=settings.DEBUG, use_reloader=settings.USE_RELOADER)
-    else:
-        print(f"Starting waitress server on http://127.0.0.1:{settings.SERVER_PORT}")
-        waitress.serve(app, host="0.0.0.0", port=settings.SERVER_PORT, threads=6)
+    # run.py stops the server processes by SIGTERM, each of them saves its caches before exiting
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        if settings.DEBUG:
+            app.run(debug=settings.DEBUG, use_reloader=settings.USE_RELOADER)
+        elif sock is not None:
+            print(f"Starting waitress server (pid {os.getpid()}) on http://127.0.0.1:{settings.SERVER_PORT}")
+            waitress.serve(app, sockets=[sock], threads=6)
+        else:
+            print(f"Starting waitress server on http://127.0.0.1:{settings.SERVER_PORT}")
+            waitress.serve(app, host="0.0.0.0", port=settings.SERVER_PORT, threads=6)
+    finally:
+        views.stop()
     
 if __name__ == "__main__":    
     run_app()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the inference settings, run on the images of the library:
+
+    python benchmarks.py precision [--images 256] [--batch-size 32] [--k 10]
+    python benchmarks.py calibrate [--images 64] [--batch-sizes 1,2,4,...] [--threads 1,2,4,...] [--save]
+
+The precision report embeds a sample of the library in each precision mode
+of CLIPWrapper (see INFERENCE_PRECISION) and compares them with fp32: the
+throughput of embedding the images and the texts, the cosine similarity of
+the embeddings, and the agreement of the top-k results of the queries (the
+fraction of the fp32 top-k found by the mode).
+
+The calibration embeds a sample of the library by the configured model,
+backend and precision with each combination of the batch sizes and the
+numbers of threads, and measures the throughput and the peak memory of the
+inference. The fastest configuration (or the one using the least memory
+among those within 5 % of it) is printed, and with --save it is stored in
+INGEST_TUNING in settings.json, where the ingestion picks it up.
+"""
+import argparse
+import resource
+import threading
+import numpy as np
+import PIL.Image
+import torch
+from time import perf_counter
+from settings import settings
+from CLIPWrapper import CLIPWrapper
+from OnnxEncoder import OnnxEncoder
+from FileScanner import FileScanner
+from ImageManager import ImageManager
+from IngestPipeline import IngestPipeline
+from InferenceExecutor import InferenceExecutor
+
+
+texts = [
+    "a photo of a dog", "a photo of a cat", "a red car", "a city at night", "a beach with palm trees",
+    "a portrait of a woman", "a bowl of fruit", "a snowy mountain", "a diagram", "people playing football",
+    "a bird on a branch", "an old building", "a plate of food", "a forest in autumn", "a boat on a lake",
+    "a screenshot of a website",
+]
+
+
+# Returns up to `count` images of the library preprocessed by the model.
+def load_images(clip, count):
+    scanner = FileScanner(ImageManager.image_formats, workers=settings.SCAN_WORKERS)
+    tensors = []
+    for path in sorted(scanner.scan(settings.DB_IMAGES_ROOT)):
+        if len(tensors) >= count:
+            break
+        try:
+            with PIL.Image.open(path) as img:
+                tensors.append(clip.preprocess_image(img))
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+    if not tensors:
+        raise SystemExit(f"No images found in {settings.DB_IMAGES_ROOT}")
+    return torch.stack(tensors)
+
+
+def normalize(embeddings):
+    embeddings = embeddings.float().cpu().numpy()
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+# Embeds the images (after one warm-up batch), returns the normalized embeddings and the images per second.
+def embed_images(clip, images, batch_size):
+    clip.encode_images(images[:batch_size])
+    start = perf_counter()
+    embeddings = torch.cat([clip.encode_images(images[i : i + batch_size]) for i in range(0, len(images), batch_size)])
+    return normalize(embeddings), len(images) / (perf_counter() - start)
+
+
+# Embeds the texts one by one (as the queries come), returns the normalized embeddings and the texts per second.
+def embed_texts(clip):
+    clip.encode_texts(texts[:1])
+    start = perf_counter()
+    embeddings = torch.cat([clip.encode_texts([text]) for text in texts])
+    return normalize(embeddings), len(texts) / (perf_counter() - start)
+
+
+# Returns the indices of the k most similar images for each query.
+def top_k(queries, images, k):
+    return np.argsort(-(queries @ images.T), axis=1, kind="stable")[:, :k]
+
+
+# Returns the mean fraction of the expected top-k results found in the actual ones.
+def agreement(expected, actual):
+    return np.mean([len(set(e) & set(a)) / len(e) for e, a in zip(expected.tolist(), actual.tolist())])
+
+
+def precision_report(args):
+    results = []
+    reference = None
+    images = None
+    for precision in CLIPWrapper.precisions:
+        clip = CLIPWrapper(model_name=settings.MODEL_NAME, prefer_cuda=False, precision=precision)
+        if clip.precision != precision:
+            print(f"Skipping {precision} (not supported)")
+            continue
+        if images is None:
+            images = load_images(clip, args.images)
+        image_embeddings, images_per_second = embed_images(clip, images, args.batch_size)
+        text_embeddings, texts_per_second = embed_texts(clip)
+        k = min(args.k, len(images))
+        # Queries: the texts, and the first images of the sample (searching for the similar images)
+        queries = (text_embeddings, image_embeddings[: min(32, len(images))])
+        results_k = [top_k(query, image_embeddings, k) for query in queries]
+        if reference is None:
+            reference = (image_embeddings, text_embeddings, results_k, images_per_second, texts_per_second)
+        similarity = min(
+            np.min(np.sum(embeddings * expected, axis=1))
+            for embeddings, expected in ((image_embeddings, reference[0]), (text_embeddings, reference[1]))
+        )
+        results.append((
+            precision,
+            images_per_second,
+            images_per_second / reference[3],
+            texts_per_second,
+            texts_per_second / reference[4],
+            similarity,
+            agreement(reference[2][0], results_k[0]),
+            agreement(reference[2][1], results_k[1]),
+        ))
+
+    print()
+    print(f"Model {settings.MODEL_NAME}, {len(images)} images, batch size {args.batch_size}, "
+          f"{torch.get_num_threads()} threads, top-{args.k}")
+    print(f"{'precision':>9} {'images/s':>9} {'speedup':>8} {'texts/s':>8} {'speedup':>8} "
+          f"{'min cos':>8} {'text@k':>7} {'image@k':>8}")
+    for row in results:
+        print("{:>9} {:>9.1f} {:>7.2f}x {:>8.1f} {:>7.2f}x {:>8.4f} {:>7.3f} {:>8.3f}".format(*row))
+
+
+# Returns the resident memory of the process in bytes.
+def resident_memory():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Only the peak of the whole process is known
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Measures the peak memory used by the code within the context (above the memory used when it was entered).
+class MemorySampler:
+    def __init__(self, device, interval=0.005):
+        self.device = device
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            self.baseline = torch.cuda.memory_allocated()
+            return self
+        self.baseline = resident_memory()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, resident_memory() - self.baseline)
+
+    def __exit__(self, *exc):
+        if self.device == "cuda":
+            self.peak = torch.cuda.max_memory_allocated() - self.baseline
+        else:
+            self.stopped.set()
+            self.thread.join()
+            self.peak = max(self.peak, resident_memory() - self.baseline)
+
+
+# Returns the powers of two up to the limit (and the limit itself).
+def powers_of_two(limit):
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+
+def calibrate(args):
+    clip = CLIPWrapper.Create(
+        model_name=settings.MODEL_NAME,
+        prefer_cuda=settings.PREFER_CUDA,
+        backend=settings.INFERENCE_BACKEND,
+        export_dir=settings.INFERENCE_EXPORT_DIR,
+        precision=settings.INFERENCE_PRECISION,
+    )
+    batch_sizes = args.batch_sizes or powers_of_two(64)
+    threads = args.threads or powers_of_two(InferenceExecutor.available_cores())
+    if clip.device == "cuda":
+        # The threads do not matter for the inference on GPU
+        threads = threads[-1:]
+    images = load_images(clip, max(args.images, max(batch_sizes)))
+
+    results = []
+    for thread_count in threads:
+        InferenceExecutor.configure_threads(thread_count)
+        if isinstance(clip.encoder, OnnxEncoder):
+            # The threads of an ONNX Runtime session are fixed when it is created (the export is reused)
+            clip.load_backend("onnx", thread_count, settings.INFERENCE_EXPORT_DIR)
+        for batch_size in batch_sizes:
+            try:
+                clip.encode_images(images[:batch_size])
+                with MemorySampler(clip.device) as memory:
+                    start = perf_counter()
+                    for i in range(0, len(images), batch_size):
+                        clip.encode_images(images[i : i + batch_size])
+                    images_per_second = len(images) / (perf_counter() - start)
+            except Exception as e:
+                if not IngestPipeline.out_of_memory(e):
+                    raise
+                # The larger batches would not fit either
+                print(f"{thread_count:>7} {batch_size:>10}  out of memory")
+                break
+            results.append((thread_count, batch_size, images_per_second, memory.peak / 2**20))
+            print("{:>7} {:>10} {:>9.1f} images/s {:>8.0f} MB".format(*results[-1]))
+
+    fastest = max(result[2] for result in results)
+    best = min((result for result in results if result[2] >= 0.95 * fastest), key=lambda result: result[3])
+    print()
+    print(f"Model {clip.embedding_name} ({settings.INFERENCE_BACKEND} on {clip.device}), {len(images)} images")
+    print(f"Best: batch size {best[1]}, {best[0]} threads, {best[2]:.1f} images/s, peak memory {best[3]:.0f} MB")
+    if args.save:
+        settings.INGEST_TUNING[clip.embedding_name] = {
+            "batch_size": best[1],
+            "threads": best[0],
+            "backend": settings.INFERENCE_BACKEND,
+            "device": clip.device,
+            "images_per_second": round(best[2], 1),
+        }
+        settings.save()
+
+
+# Parses a comma-separated list of positive integers.
+def int_list(value):
+    values = [int(item) for item in value.split(",") if item.strip()]
+    if not values or min(values) < 1:
+        raise argparse.ArgumentTypeError("expected a comma-separated list of positive integers")
+    return sorted(set(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the inference settings.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    precision = subparsers.add_parser("precision", help="compare the precision modes with fp32")
+    precision.add_argument("--images", type=int, default=256, help="number of images of the library to embed")
+    precision.add_argument("--batch-size", type=int, default=32)
+    precision.add_argument("--k", type=int, default=10, help="number of results compared for each query")
+    precision.set_defaults(run=precision_report)
+    calibration = subparsers.add_parser("calibrate", help="find the fastest batch size and number of threads")
+    calibration.add_argument("--images", type=int, default=64, help="number of images of the library to embed")
+    calibration.add_argument("--batch-sizes", type=int_list, help="batch sizes to try (powers of two up to 64)")
+    calibration.add_argument("--threads", type=int_list, help="numbers of threads to try (powers of two up to the cores)")
+    calibration.add_argument("--save", action="store_true", help="store the best configuration in settings.json")
+    calibration.set_defaults(run=calibrate)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
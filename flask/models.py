@@ -1,11 +1,16 @@
+import os
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import event, delete, func, insert, or_, select, update
 from sqlalchemy.engine import Engine
 from sqlite3 import Connection as SQLite3Connection
+from utils import batched
 
 
 db = SQLAlchemy()
 
+# Number of rows written by a single executemany() call
+BULK_CHUNK_SIZE = 10000
+
 
 class Image(db.Model):
     __tablename__ = "image"
@@ -22,4 +27,94 @@ def _set_sqlite_pragma(dbapi_connection, connection_record):
     if isinstance(dbapi_connection, SQLite3Connection):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON;")
+        # Readers do not block the writer (and vice versa), and the commits
+        # are not synced to the disk one by one
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=NORMAL;")
+        # 64 MB of page cache
+        cursor.execute("PRAGMA cache_size=-65536;")
+        cursor.execute("PRAGMA temp_store=MEMORY;")
         cursor.close()
+
+
+"""
+Bulk operations on the image table. They bypass the ORM (no Image objects are
+created), so they are suitable for libraries with millions of images. None of
+them commits the changes.
+"""
+
+# Yields the rows (id, path, timestamp) of all the images, fetched in chunks.
+def select_images(chunk_size=BULK_CHUNK_SIZE):
+    query = select(Image.id, Image.path, Image.timestamp).execution_options(yield_per=chunk_size)
+    yield from db.session.execute(query)
+
+
+# Yields the rows (id, path, timestamp) of the images with the given paths, or within the given directories.
+def select_images_by_paths(paths, chunk_size=100):
+    seen = set()
+    for chunk in batched(list(paths), k=chunk_size):
+        chunk_paths = {os.path.normpath(path) for path in chunk}
+        conditions = []
+        for path in chunk:
+            path = os.path.normpath(path)
+            prefix = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append(Image.path == path)
+            conditions.append(Image.path.like(prefix + os.sep.replace("\\", "\\\\") + "%", escape="\\"))
+        prefixes = tuple(os.path.normpath(path) + os.sep for path in chunk)
+        for row in db.session.execute(select(Image.id, Image.path, Image.timestamp).where(or_(*conditions))):
+            # LIKE is not case-sensitive, and the paths may overlap (a file and its directory)
+            if (row.path in chunk_paths or row.path.startswith(prefixes)) and row.id not in seen:
+                seen.add(row.id)
+                yield row
+
+
+# Yields the rows (id, path, timestamp) of the images with the given ids.
+def select_images_by_ids(ids, chunk_size=500):
+    for chunk in batched(list(ids), k=chunk_size):
+        yield from db.session.execute(select(Image.id, Image.path, Image.timestamp).where(Image.id.in_(chunk)))
+
+
+"""
+Inserts the images given by pairs (path, timestamp) and returns the list of
+their ids. The ids are assigned explicitly (increasing from the largest id in
+the table), so they are known without reading the rows back.
+"""
+def insert_images(rows, chunk_size=BULK_CHUNK_SIZE):
+    next_id = max_image_id() + 1
+    ids = []
+    for chunk in batched(rows, k=chunk_size):
+        chunk_ids = range(next_id, next_id + len(chunk))
+        db.session.execute(
+            insert(Image),
+            [{"id": id, "path": path, "timestamp": timestamp} for id, (path, timestamp) in zip(chunk_ids, chunk)],
+        )
+        ids.extend(chunk_ids)
+        next_id += len(chunk)
+    return ids
+
+
+# Returns the largest id of the images (0 if there are none).
+def max_image_id():
+    return db.session.execute(select(func.max(Image.id))).scalar() or 0
+
+
+# Sets the timestamps of the images given by pairs (id, timestamp).
+def update_timestamps(rows, chunk_size=BULK_CHUNK_SIZE):
+    for chunk in batched(rows, k=chunk_size):
+        db.session.execute(update(Image), [{"id": id, "timestamp": timestamp} for id, timestamp in chunk])
+
+
+# Deletes the images given by their ids.
+def delete_images(ids, chunk_size=500):
+    for chunk in batched(ids, k=chunk_size):
+        db.session.execute(delete(Image).where(Image.id.in_(chunk)))
+
+
+# Deletes the images with larger ids than the given one.
+def delete_images_after(id):
+    db.session.execute(delete(Image).where(Image.id > id))
+
+
+# Deletes all the images.
+def delete_all_images():
+    db.session.execute(delete(Image))
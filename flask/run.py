@@ -1,14 +1,16 @@
 import os
 import secrets
+import socket
+import time
 from multiprocessing import Process
-from multiprocessing.connection import Listener, Client
+from multiprocessing.connection import Listener, Client, wait
 from pathlib import Path
 from datetime import datetime
 from settings import settings
 
 runner_passwd = secrets.token_bytes(16)
 
-def process_main():
+def process_main(sock=None):
     from app import run_app
 
     address = ('localhost', settings.RUNNER_PORT)
@@ -17,49 +19,76 @@ def process_main():
     #filename = log_dir / ("log-" + datetime.now().strftime("%Y-%m-%d_%M-%H-%S") + ".txt")
     #with open(str(filename), "w", buffering=1) as f:
         #run_app(conn, f)
-    run_app(conn)
+    run_app(conn, sock=sock)
 
 
-def run_process():
-    process = Process(target=process_main)
+def run_process(sock=None):
+    process = Process(target=process_main, args=(sock,))
     process.start()
     return process
 
 
-def stop_process(process, timeout=5):
-    process.join(timeout)
-    if process.is_alive():
-        print("App is still running after {timeout} seconds. Force stopping.")
-        process.terminate()
+# Signals all the app processes to stop (they save their caches, see app.run_app) and waits for them together.
+def stop_processes(processes, timeout=5):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+    for process in processes:
+        if process.is_alive():
+            print(f"App (pid {process.pid}) is still running after {timeout} seconds. Force stopping.")
+            process.kill()
+            process.join()
 
 
 def main():
     log_dir = Path(os.path.realpath(__file__)).parent / "logs"
     log_dir.mkdir(exist_ok=True)
 
-    process = None
-    conn = None
+    processes = []
+    conns = []
+    sock = None
     address = ('localhost', settings.RUNNER_PORT)
     listener = Listener(address, authkey=runner_passwd)
 
+    # With SERVER_WORKERS > 1, the app processes accept the connections
+    # from one listening socket (see "Multi-process serving" in the docs)
     def start_app():
-        nonlocal process, conn
+        nonlocal sock
         settings.load()
-        process = run_process()
-        print("Waiting for connection...")
-        conn = listener.accept()
+        if settings.SERVER_WORKERS > 1:
+            sock = socket.create_server(("0.0.0.0", settings.SERVER_PORT), backlog=1024)
+        for _ in range(max(1, settings.SERVER_WORKERS)):
+            processes.append(run_process(sock))
+            print("Waiting for connection...")
+            conns.append(listener.accept())
         print("Connection established!")
 
     def stop_app():
-        conn.close()
-        stop_process(process)
+        nonlocal sock
+        for conn in conns:
+            conn.close()
+        stop_processes(processes)
+        conns.clear()
+        processes.clear()
+        if sock is not None:
+            sock.close()
+            sock = None
         print("App stopped!")
     
 
     start_app()
-    while True:
-
-        data = conn.recv()
+    while conns:
+
+        # Any of the app processes can ask for restarting or shutting down all of them
+        conn = wait(conns)[0]
+        try:
+            data = conn.recv()
+        except EOFError:
+            conns.remove(conn)
+            continue
         print(":", data)
 
         if data == "restart":
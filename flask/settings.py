@@ -24,6 +24,8 @@ class Settings:
 
         self.TAG_EMBED_CACHE_TTL = 15 * 60  # 15 minutes before expiration
         self.TAG_EMBED_CACHE_SIZE = 32
+        # Database of the session ids and the cached embeddings, shared by the server processes
+        self.SESSION_DB_PATH = "instance/sessions.db"
 
         self.DEBUG = False
         self.USE_RELOADER = False
@@ -31,8 +33,85 @@ class Settings:
 
         self.SERVER_PORT = 5000
         self.RUNNER_PORT = 16060
+        # Number of server processes accepting the connections from one port (they share the index files)
+        self.SERVER_WORKERS = 1
 
         self.BATCH_SIZE = 1
+        # Batch size and inference threads measured by `python benchmarks.py calibrate` for each model
+        # (they replace BATCH_SIZE, and INFERENCE_THREADS if it is 0); the batches are halved when
+        # the inference runs out of memory or less than INGEST_MIN_FREE_MB of memory is available
+        self.INGEST_TUNING = {}
+        self.INGEST_MIN_FREE_MB = 256
+        # Number of threads decoding the images and number of batches prepared ahead of the model
+        self.INGEST_WORKERS = 4
+        self.INGEST_PREFETCH = 2
+        # Building the library from scratch is saved in chunks of INGEST_CHECKPOINT_SIZE images to
+        # INGEST_CHECKPOINT_DIR, so it resumes from the last chunk after an interruption
+        self.INGEST_CHECKPOINT_SIZE = 1024
+        self.INGEST_CHECKPOINT_DIR = "instance/checkpoints"
+        # Number of threads listing the directories of the library
+        self.SCAN_WORKERS = 8
+        # Watching the library for changes: by the events of the file system (requires watchdog) or by scanning
+        # it every WATCH_POLL_INTERVAL seconds; the changes are ingested WATCH_DEBOUNCE_MS after the last one,
+        # but at most WATCH_MAX_DELAY seconds after the first one
+        self.WATCH_LIBRARY = False
+        self.WATCH_EVENTS = True
+        self.WATCH_POLL_INTERVAL = 10
+        self.WATCH_DEBOUNCE_MS = 2000
+        self.WATCH_MAX_DELAY = 30
+        # Concurrent queries are embedded together in micro-batches of at most INFERENCE_MAX_BATCH_SIZE
+        # inputs, waiting at most INFERENCE_MAX_WAIT_MS for them; INFERENCE_THREADS = 0 uses all the cores
+        self.INFERENCE_MAX_BATCH_SIZE = 32
+        self.INFERENCE_MAX_WAIT_MS = 5
+        self.INFERENCE_THREADS = 0
+        # Backend running the CLIP encoders on CPU: "torch" (eager), "torchscript" or "onnx" (requires
+        # onnxruntime); the encoders are exported to INFERENCE_EXPORT_DIR when the application starts
+        self.INFERENCE_BACKEND = "torch"
+        self.INFERENCE_EXPORT_DIR = "instance/exported"
+        # Precision of the inference on CPU: "fp32", "int8" (dynamically quantized linear layers) or "bf16"
+        # (bfloat16 autocast, on the supporting CPUs); each mode has its own index
+        self.INFERENCE_PRECISION = "fp32"
+        # Persistent cache of image embeddings keyed by the file content and model
+        self.EMBEDDING_CACHE = True
+        self.EMBEDDING_CACHE_PATH = "instance/embedding_cache.db"
+
+        # Thumbnails of the library images shown on the result pages (created by the ingestion, or when
+        # requested): the longer side in pixels, the WebP quality, the directory, and how long (in seconds)
+        # the browsers may cache them
+        self.THUMBNAILS = True
+        self.THUMBNAIL_SIZE = 320
+        self.THUMBNAIL_QUALITY = 80
+        self.THUMBNAIL_DIR = "instance/thumbnails"
+        self.THUMBNAIL_MAX_AGE = 7 * 24 * 60 * 60
+
+        # Number of cached text query embeddings, and whether and where they are saved to survive restarts
+        self.TEXT_CACHE_SIZE = 1024
+        self.TEXT_CACHE_PERSIST = True
+        self.TEXT_CACHE_PATH = "instance/text_embedding_cache.npz"
+        # Memory budget of the cached ranked results and number of pages fetched ahead of the requested one
+        self.RESULT_CACHE_SIZE_MB = 64
+        self.RESULT_CACHE_PREFETCH_PAGES = 4
+
+        # Index used for the search: "flat" (exact), "ivf" or "hnsw" (approximate)
+        self.INDEX_TYPE = "flat"
+        # Compact codes of the embeddings scored by the exact ("flat") index: "float32" (no codes), "float16"
+        # or "int8"; the EMBEDDING_RERANK * k best candidates are scored again exactly (0 disables it)
+        self.EMBEDDING_STORAGE = "float32"
+        self.EMBEDDING_RERANK = 4
+        # Number of worker processes searching the exact index in parallel (1 searches in the application process)
+        self.SHARD_COUNT = 1
+        # Precomputed nearest neighbours of each image for browsing the library (computed by refreshing
+        # the library): number of neighbours and memory budget of the computation
+        self.KNN_TABLE = False
+        self.KNN_SIZE = 100
+        self.KNN_MEMORY_MB = 256
+        # Number of inverted lists of the IVF index and number of lists searched by each query
+        self.IVF_NLIST = 1024
+        self.IVF_NPROBE = 16
+        # Number of neighbours of the HNSW graph nodes and sizes of the candidate lists
+        self.HNSW_M = 16
+        self.HNSW_EF_CONSTRUCTION = 100
+        self.HNSW_EF_SEARCH = 64
 
     def get_values(self):
         return dict(self.__dict__)
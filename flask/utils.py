@@ -1,8 +1,15 @@
 from contextlib import contextmanager, ExitStack
 from typing import Callable, Any, Sized, Generator, Tuple, Iterable, Optional
+import os
 import threading
 from math import ceil
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows (the lock is then held only within the process)
+    fcntl = None
+
 
 class ReadWriteLock:
     """A lock object that allows many simultaneous "read locks", but
@@ -89,6 +96,77 @@ def acquire_write(
         yield success
 
 
+class FileLock:
+    """An exclusive lock shared by all the processes opening the same file.
+    It is exclusive among the threads of one process as well, and it can be
+    released by another thread than the one that acquired it."""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Acquire the lock, blocking or non-blocking."""
+        if not self._lock.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BaseException as e:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._lock.release()
+            if isinstance(e, BlockingIOError):
+                return False
+            raise
+
+    def release(self) -> None:
+        """Release the lock."""
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+class ProgressBarThread(threading.Thread):
+    """A thread running the function in the background. The function reports
+    its progress (between 0 and 1, or -1 if unknown), title and description by
+    setting the attributes of the thread. Unlike LockingProgressBarThread, it
+    does not block the other requests."""
+
+    def __init__(self, fn: Callable[..., Any]):
+        self.progress = -1.0
+        self.fn = fn
+        self.title = "Something is coming"
+        self.description = "Please wait..."
+
+        super().__init__(daemon=True)
+
+    @staticmethod
+    def from_function(fn: Callable[..., Any]):
+        return ProgressBarThread(lambda self: fn(thr=self))
+
+    def run(self) -> None:
+        try:
+            self.fn(self)
+        finally:
+            self.progress = 1.0
+
+
 class LockingProgressBarThread(threading.Thread):
     def __init__(self, rwlock: ReadWriteLock, fn: Callable[..., Any]):
         self.progress = -1.0
@@ -166,4 +244,15 @@ class LockingProgressBarThread(threading.Thread):
 def batched(iterable, k=16):
     n = len(iterable)
     for i in range(ceil(n/k)):
-        yield iterable[i*k : (i+1)*k]
\ No newline at end of file
+        yield iterable[i*k : (i+1)*k]
+
+# Returns the memory available to new processes (without swapping) in bytes, or None if it is not known.
+def available_memory():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
@@ -1,15 +1,19 @@
-from flask import render_template, request, send_from_directory, redirect, abort
+from flask import render_template, request, send_file, send_from_directory, redirect, abort
+from werkzeug.security import safe_join
 from PIL import Image
 from ImageManager import ImageManager
-from utils import LockingProgressBarThread, ReadWriteLock, acquire_read, acquire_write
+from utils import LockingProgressBarThread, ProgressBarThread, ReadWriteLock, FileLock, acquire_read, acquire_write
 from settings import settings
 from itertools import islice
 from EmbeddingTagCache import EmbeddingTagCache
-import secrets
+from ResultCache import ResultCache
+from DirectoryWatcher import DirectoryWatcher
 import clip
 import json
 from time import sleep
+import os
 import urllib
+from urllib.parse import quote
 import functools
 
 HTTP_BAD_REQUEST = 400
@@ -23,10 +27,16 @@ class Views:
         self.runner_conn = runner_conn
         self.progressbar_rwlock = ReadWriteLock()
         self.progressbar_description = ""
-        self.embedding_tag_cache = EmbeddingTagCache()
-        self.session_ids = set()
+        # Held while the library is being refreshed, so only one of the server processes changes it
+        self.writer_lock = FileLock("instance/writer.lock")
+        # Shared by all the server processes, see EmbeddingTagCache
+        self.embedding_tag_cache = EmbeddingTagCache(settings.SESSION_DB_PATH)
+        self.result_cache = ResultCache()
+        self.watcher = None
         
         self.load_image_manager()
+        self.start_index_build()
+        self.start_watcher()
 
     def progressbar_lock(title="Something is comming...", description="Oh no! You have to wait for a while...",
             *, write=False, blocking=True, timeout=0.5, progress_unknown=False
@@ -59,22 +69,96 @@ class Views:
 
         return decorator
 
-    def  load_image_manager(self, create_new_kdtree=True):
+    def  load_image_manager(self, create_new_index=True):
         self.imanager = ImageManager(
             model_name=settings.MODEL_NAME, prefer_cuda=settings.PREFER_CUDA
         )
 
-        if create_new_kdtree and self.imanager.kdtree is None:
-            print("Kdtree not found, building new...")
-            self.imanager.full_refresh()
+        if create_new_index and (self.imanager.index is None or self.imanager.checkpoint.exists()):
+            with self.writer_lock:
+                # Another server process may have built it in the meantime
+                self.imanager.sync_index()
+                if self.imanager.checkpoint.exists():
+                    print("Resuming the interrupted initialization of the library...")
+                    self.imanager.full_refresh()
+                elif self.imanager.index is None:
+                    print("Index not found, building new...")
+                    self.imanager.full_refresh()
+
+    # Builds the structures of the index that do not match its files yet (e.g. the HNSW graph after the
+    # index type was changed) in the background. The searches use the current index until they are done.
+    def start_index_build(self):
+        index = self.imanager.index
+        if index is None or not index.needs_build() or not self.writer_lock.acquire(blocking=False):
+            # Nothing to build, or another server process is changing the index (and builds them)
+            return
+
+        def build_function(thr):
+            thr.title = "Building index"
+            thr.description = "The search index is being built. The searches are slower until it is done."
+            try:
+                with self.app.app_context(), self.imanager.updating_index():
+                    for gen, n, description in self.imanager.get_build_generators():
+                        thr.description = description
+                        for i, _ in enumerate(gen):
+                            thr.progress = i/n
+            finally:
+                self.writer_lock.release()
+            self.result_cache.clear()
+
+        self.thr = ProgressBarThread.from_function(build_function)
+        self.thr.start()
+
+    # Starts watching the library for changes if WATCH_LIBRARY is enabled (only in one of the server processes).
+    def start_watcher(self):
+        if not settings.WATCH_LIBRARY or self.imanager.index is None:
+            return
+        self.watcher_lock = FileLock("instance/watcher.lock")
+        if not self.watcher_lock.acquire(blocking=False):
+            # Another server process is watching the library
+            return
+        self.watcher = DirectoryWatcher(
+            settings.DB_IMAGES_ROOT,
+            self.ingest_paths,
+            self.imanager.scanner,
+            debounce=settings.WATCH_DEBOUNCE_MS / 1000,
+            max_delay=settings.WATCH_MAX_DELAY,
+            poll_interval=settings.WATCH_POLL_INTERVAL,
+            use_events=settings.WATCH_EVENTS,
+        )
+        self.watcher.start()
+
+    # Called when the server process is stopped: saves the caches and stops the background work.
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.imanager.text_cache.save()
+        if self.imanager.sharded is not None:
+            self.imanager.sharded.close()
+
+    # Adds, updates or removes the images given by the paths (files or directories) reported by the watcher.
+    def ingest_paths(self, paths):
+        with self.writer_lock, self.app.app_context(), self.imanager.updating_index():
+            for gen, n, description in self.imanager.get_refresh_generators(paths):
+                for _ in gen:
+                    pass
 
     @staticmethod
     def process_query_result(result, page=1):
         # Get the correct "page" of results
         result = islice(result, settings.QUERY_K * (page - 1), settings.QUERY_K * page)
 
-        # Map it to pairs ('/url_for_file', '/url_for_search_by_id')
-        return [("/" + x.path, f"/search/id/{x.id}") for x in result]
+        # Map it to triples ('/url_for_file', '/url_for_search_by_id', '/url_for_thumbnail')
+        return [("/" + x.path, f"/search/id/{x.id}", Views.thumbnail_url(x)) for x in result]
+
+    # Returns the URL of the thumbnail of the image (versioned by its modified time, so it can be cached),
+    # or the URL of the image itself if the thumbnails are disabled.
+    @staticmethod
+    def thumbnail_url(record):
+        if not settings.THUMBNAILS:
+            return "/" + record.path
+        path = os.path.relpath(record.path, settings.DB_IMAGES_ROOT).replace(os.sep, "/")
+        return f"/thumbnails/{quote(path)}?v={int(record.timestamp.timestamp())}"
 
     @staticmethod
     def parse_int(string):
@@ -96,6 +180,8 @@ class Views:
             model_selected=settings.MODEL_NAME,
             results_per_page=[15, 20, 25, 30, 40, 50],
             results_per_page_selected=settings.QUERY_K,
+            index_types={"flat": "Exact", "ivf": "IVF (approximate)", "hnsw": "HNSW (approximate)"},
+            index_type_selected=settings.INDEX_TYPE,
             error_msg=error_msg,
         )
 
@@ -130,17 +216,42 @@ class Views:
         result = self.imanager.query_image(img, k=settings.QUERY_K * page)
         return self.process_query_result(result, page)
 
+    # Returns the page of results of the query given by its kind and key from self.result_cache.
+    # The search function (see ResultCache.page) is called only if the results are not cached.
+    # The results cached for the previous versions of the index are never used (see ImageManager.sync_index).
+    def query_cached(self, kind, key, search, page=1):
+        self.imanager.sync_index()
+        key = (kind, key, self.imanager.embedding_name, self.imanager.generation)
+        ids = self.result_cache.page(key, page, settings.QUERY_K, search)
+        return self.process_query_result(self.imanager.records(ids))
+
+    # Returns the search function for query_cached() that searches the index for the embedding
+    # returned by get_embedding (called only when the search is run).
+    def embedding_search(self, get_embedding):
+        def search(k):
+            ids = self.imanager.query_ids(get_embedding(), k=k)
+            return ids, len(ids) < k
+        return search
+
     def query_text(self, text, page=1):
-        result = self.imanager.query_text(text, k=settings.QUERY_K * page)
-        return self.process_query_result(result, page)
+        return self.query_cached("text", text, self.embedding_search(lambda: self.imanager.embed_text(text)), page)
 
+    # The results are taken from the precomputed nearest neighbours if they contain the requested page.
     def query_id(self, id, page=1):
-        result = self.imanager.query_id(id, k=settings.QUERY_K * page)
-        return self.process_query_result(result, page)
-
-    def query_embedding(self, embedding, page=1):
-        result = self.imanager.query(embedding, k=settings.QUERY_K * page)
-        return self.process_query_result(result, page)
+        def search(k):
+            snapshot = self.imanager.snapshot()
+            index = snapshot[0]
+            if id not in index:
+                return [], True
+            ids = self.imanager.neighbour_ids(id, snapshot)
+            if ids is not None and len(ids) >= settings.QUERY_K * page:
+                return ids[:k], False
+            return self.embedding_search(lambda: index.vector(id))(k)
+        return self.query_cached("id", id, search, page)
+
+    # The tag identifies the embedding itself (see EmbeddingTagCache.add), so the results can be shared by the sessions.
+    def query_embedding(self, embedding, tag, page=1):
+        return self.query_cached("tag", tag, self.embedding_search(lambda: embedding), page)
 
     @progressbar_lock()
     def index(self):
@@ -165,7 +276,7 @@ class Views:
                                please upload your image again."
             )
 
-        result = self.query_embedding(embedding, page)
+        result = self.query_embedding(embedding, tag, page)
         return self.render_search_results(result, page, request.args)
 
     @progressbar_lock()
@@ -187,7 +298,7 @@ class Views:
             cookies = request.cookies
             if (
                 "session_id" not in cookies
-                or cookies["session_id"] not in self.session_ids
+                or not self.embedding_tag_cache.has_session(cookies["session_id"])
             ):
                 result = self.query_image(img, page)
                 print("Query (image, no session_id), page {page}")
@@ -250,6 +361,9 @@ class Views:
 
     @progressbar_lock()
     def settings_get(self):
+        # The progress of the library refresh running in the background
+        if isinstance(self.thr, ProgressBarThread) and self.thr.progress < 1.0:
+            return render_template("progress.html", title=self.thr.title, description=self.thr.description)
         return self.render_settings()
 
     # No @progressbar_lock() here, we need to handle it manually
@@ -264,9 +378,16 @@ class Views:
             backup = settings.get_values()
             K = int(request.form["results_per_page"])
             model_name = request.form["model"]
+            index_type = request.form["index_type"]
+            if index_type not in ImageManager.index_types:
+                return False
 
-            model_change = request.form["model"] != settings.MODEL_NAME
+            # Changing the index type requires restart as well
+            model_change = (
+                model_name != settings.MODEL_NAME or index_type != settings.INDEX_TYPE
+            )
             settings.MODEL_NAME = model_name
+            settings.INDEX_TYPE = index_type
             settings.QUERY_K = K
 
             if not settings.save():
@@ -275,7 +396,7 @@ class Views:
             return True
 
         def try_lock_and_run(composite):
-            if model_change or self.imanager.kdtree is None:
+            if model_change or self.imanager.index is None:
                 with acquire_write(self.progressbar_rwlock, True, 1.0) as success:
                     # If acquired and EITHER there was no previous self.thr
                     # OR there was and it has already finished:
@@ -292,6 +413,7 @@ class Views:
                 thr.title = "Restarting"
                 thr.description = "Application is restarting. Please reload the page in a few seconds."
 
+                self.imanager.text_cache.save()
                 if self.runner_conn is not None:
                     self.runner_conn.send("restart")
                     self.runner_conn.close()
@@ -321,17 +443,43 @@ class Views:
     def session_id(self):
         if "session_id" in request.cookies:
             id = request.cookies["session_id"]
-            if id in self.session_ids:
+            if self.embedding_tag_cache.has_session(id):
                 return id
-
-        id = secrets.token_hex(16)
-        while id in self.session_ids:
-            id = secrets.token_hex(16)
-        self.session_ids.add(id)
-        return id
+        return self.embedding_tag_cache.new_session()
 
     def get_db_image(self, filename, as_attachment=False):
         return send_from_directory(settings.DB_IMAGES_ROOT, filename, as_attachment=as_attachment)
+
+    """
+    Serves the thumbnail of the library image (creating it if it is missing).
+    The ETag identifies the thumbnail of the current version of the image, so
+    the browsers revalidate the cached thumbnails without downloading them.
+    If the thumbnail cannot be created, the image itself is served.
+    """
+    def get_thumbnail(self, filename):
+        thumbnails = self.imanager.thumbnails
+        if thumbnails is None:
+            return self.get_db_image(filename)
+        path = safe_join(settings.DB_IMAGES_ROOT, filename)
+        if path is None:
+            abort(404)
+        try:
+            stat = os.stat(path)
+            thumbnail = thumbnails.get_or_create(path, stat.st_mtime_ns)
+        except FileNotFoundError:
+            abort(404)
+        except OSError:
+            return self.get_db_image(filename)
+        response = send_file(
+            thumbnail,
+            mimetype=thumbnails.mimetype,
+            etag=os.path.splitext(os.path.basename(thumbnail))[0],
+            last_modified=stat.st_mtime,
+            max_age=settings.THUMBNAIL_MAX_AGE,
+            conditional=True,
+        )
+        response.cache_control.public = True
+        return response
     
     def error(self, description, title="Error"):
         return render_template("error.html", title=title, description=description)
@@ -358,6 +506,7 @@ class Views:
                     title="Couldn't shutdown the application",
                     description="Application shutting down failed, please try again in a moment.")
             
+        self.imanager.text_cache.save()
         if self.runner_conn is not None:
             self.runner_conn.send("shutdown")
             self.runner_conn.close()
@@ -385,6 +534,7 @@ class Views:
                     title="Couldn't restart the application",
                     description="Application restarting failed, please reload the page and try again in a moment.")
             
+        self.imanager.text_cache.save()
         if self.runner_conn is not None:
             self.runner_conn.send("restart")
             self.runner_conn.close()
@@ -395,22 +545,28 @@ class Views:
         with acquire_write(self.progressbar_rwlock, True, 1.0) as success:
             # If acquired and EITHER there was no previous self.thr
             # OR there was and it has already finished:
-            if success and (self.thr is None or self.thr.progress == 1.0):
+            if success and (self.thr is None or self.thr.progress == 1.0) \
+                    and self.writer_lock.acquire(blocking=False):
                 # Start a new thread with our function (and with unique lock)
                 
                 def refresh_function(thr):
                     thr.title = "Resetting library"
                     thr.description = "The database is being refreshed. Please wait... The page will reload automatically."
 
-                    self.embedding_tag_cache = EmbeddingTagCache()
-                    with self.app.app_context():
-                        for gen, n, description in self.imanager.get_full_refresh_generators():
-                            thr.description = description
-                            for i, _ in enumerate(gen):
-                                thr.progress = i/n
-
-                self.thr = LockingProgressBarThread.from_function(
-                    self.progressbar_rwlock, refresh_function)
+                    self.embedding_tag_cache.clear()
+                    self.result_cache.clear()
+                    try:
+                        with self.app.app_context(), self.imanager.updating_index():
+                            for gen, n, description in self.imanager.get_full_refresh_generators():
+                                thr.description = description
+                                for i, _ in enumerate(gen):
+                                    thr.progress = i/n
+                    finally:
+                        self.writer_lock.release()
+                    self.result_cache.clear()
+
+                # The searches are not blocked, they use the current index until the new one replaces it
+                self.thr = ProgressBarThread.from_function(refresh_function)
                 self.thr.start()
 
             else:
@@ -423,21 +579,26 @@ class Views:
         with acquire_write(self.progressbar_rwlock, True, 1.0) as success:
             # If acquired and EITHER there was no previous self.thr
             # OR there was and it has already finished:
-            if success and (self.thr is None or self.thr.progress == 1.0):
+            if success and (self.thr is None or self.thr.progress == 1.0) \
+                    and self.writer_lock.acquire(blocking=False):
                 # Start a new thread with our function (and with unique lock)
                 
                 def refresh_function(thr):
                     thr.title = "Refreshing library"
                     thr.description = "The database is being refreshed. Please wait... The page will reload automatically."
 
-                    with self.app.app_context():
-                        for gen, n, description in self.imanager.get_refresh_generators():
-                            thr.description = description
-                            for i, _ in enumerate(gen):
-                                thr.progress = i/n
-
-                self.thr = LockingProgressBarThread.from_function(
-                    self.progressbar_rwlock, refresh_function)
+                    try:
+                        with self.app.app_context(), self.imanager.updating_index():
+                            for gen, n, description in self.imanager.get_refresh_generators():
+                                thr.description = description
+                                for i, _ in enumerate(gen):
+                                    thr.progress = i/n
+                    finally:
+                        self.writer_lock.release()
+                    self.result_cache.clear()
+
+                # The searches are not blocked, they use the current index until the new one replaces it
+                self.thr = ProgressBarThread.from_function(refresh_function)
                 self.thr.start()
 
             else: